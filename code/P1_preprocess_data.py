@@ -1,63 +1,75 @@
-from os.path import join, basename, dirname, abspath
+from os.path import join, basename, dirname, abspath, exists
 from os import remove, rename, makedirs
 from joblib import Parallel, delayed
 from shutil import rmtree
 from tqdm import tqdm
-from osgeo import ogr
 import numpy as np
 import glob
 
 from geo_tools import (
-    gdal_clip_shp_raster,
-    gdal_merge_rasters,
+    build_stack_vrt,
+    stack_rasters,
     check_data,
     check_ResProj_files,
     apply_function,
+    compile_band_chain,
     mask_layover,
+    cached_massif_windows,
+    fused_scene_pass,
+    raster_grid,
+    clip_raster_massifs,
+    shapefile_hash,
 )
+from manifest import Manifest
 
 
-def clip_shp(inraster, shp, stations_id, ouput_path, add_aux):
+def clip_name(inraster, stations_id, ouput_path, add_aux):
     if add_aux:
-        outraster = join(
-            ouput_path, stations_id + "_" + basename(inraster)[:6] + ".tif"
-        )
+        return join(ouput_path, stations_id + "_" + basename(inraster)[:6] + ".tif")
     else:
-        outraster = join(
+        return join(
             ouput_path, stations_id + "_" + extract_date(basename(inraster)) + ".tif"
         )
-    gdal_clip_shp_raster(inraster, shp, outraster, stations_id)
-
-
-def clip_multiple_shp(
-    data_path, name_shp, stations_id, ouput_path, add_aux, workers=-1
-):
-    Parallel(n_jobs=workers)(
-        delayed(clip_shp)(inraster, name_shp, stations_id, ouput_path, add_aux)
-        for inraster in glob.glob(data_path)
-    )
 
 
-def select_data(data_path, ouput_path, shptr_path, add_aux, workers):
+def select_data(data_path, ouput_path, shptr_path, add_aux, parallel, cache_dir):
+    """Clip every raster on every massif of the shapefile, each raster is
+    opened once and the massif windows are computed once per grid (and
+    cached in cache_dir for the next runs)"""
     name_shp = abspath(glob.glob(shptr_path)[0])
-    ds = ogr.Open(name_shp)
-    lyr = ds.GetLayer(0)
-    lyr.ResetReading()
-    ft = lyr.GetNextFeature()
-    while ft:
-        stations_id = ft.GetFieldAsString("id")
-        clip_multiple_shp(
-            data_path, name_shp, stations_id, ouput_path, add_aux, workers
+    list_rasters = glob.glob(data_path)
+    grids = {inraster: raster_grid(inraster) for inraster in list_rasters}
+    windows = {
+        grid: cached_massif_windows(name_shp, grid[0], grid[1], grid[2], cache_dir)
+        for grid in set(grids.values())
+    }
+    parallel(
+        delayed(clip_raster_massifs)(
+            inraster,
+            windows[grids[inraster]],
+            {
+                sta: clip_name(inraster, sta, ouput_path, add_aux)
+                for sta in windows[grids[inraster]]
+            },
         )
-        ft = lyr.GetNextFeature()
+        for inraster in tqdm(list_rasters)
+    )
 
 
 def data_clipping(data_path, shp_path, ouput_dir, folders, add_aux, workers):
-    for folder in folders:
-        ouput_path = join(ouput_dir, "pre_process_E0", folder)
-        makedirs(ouput_path, exist_ok=True)
-        shptr_path = shp_path + f"{folder}/*.shp"
-        select_data(data_path, ouput_path, shptr_path, add_aux, workers)
+    with Parallel(n_jobs=workers) as parallel:
+        for folder in folders:
+            ouput_path = join(ouput_dir, "pre_process_E0", folder)
+            makedirs(ouput_path, exist_ok=True)
+            shptr_path = shp_path + f"{folder}/*.shp"
+            select_data(
+                data_path,
+                ouput_path,
+                shptr_path,
+                add_aux,
+                parallel,
+                join(ouput_dir, "cache"),
+            )
 
 
 def data_merge(ouput_dir, folders, typeaux):
@@ -65,20 +77,23 @@ def data_merge(ouput_dir, folders, typeaux):
         ouput_path = join(ouput_dir, "pre_process_E0", folder, "*.tif")
         list_tif = glob.glob(ouput_path)
         list_tif.sort()
+        # the auxiliary stack of a massif is the same for every date
+        aux_stacks = {}
         for i in list_tif:
             sta = extract_stations_id(i)
             if check_current_file_not_aux(i, sta, typeaux):
                 exist_aux, list_aux = check_exist_aux_files(i, list_tif, sta, typeaux)
                 if exist_aux:
-                    in_rast = i
-                    m = "#"
-                    for l_aux in list_aux:
-                        out_rast = dirname(i) + f"/{sta}_{m}_temp.tif"
-                        gdal_merge_rasters(in_rast, l_aux, out_rast)
-                        remove(in_rast)
-                        in_rast = out_rast
-                        m += "#"
-                    rename(in_rast, i)
+                    if sta not in aux_stacks:
+                        aux_stacks[sta] = build_stack_vrt(
+                            list_aux, join(dirname(i), f"{sta}_AUX.vrt")
+                        )
+                    out_rast = join(dirname(i), f"{sta}_#_temp.tif")
+                    stack_rasters([i, aux_stacks[sta]], out_rast)
+                    remove(i)
+                    rename(out_rast, i)
+        for i in aux_stacks.values():
+            remove(i)
         for i in list_tif:
             sta = extract_stations_id(i)
             if not (check_current_file_not_aux(i, sta, typeaux)):
@@ -126,12 +141,108 @@ def transformation_data(ouput_dir, folders, dic_bands, workers):
     for folder in folders:
         ouput_path = join(ouput_dir, "pre_process_E0", folder, "*.tif")
         list_tif = glob.glob(ouput_path)
+        chain = compile_band_chain(dic_bands)
         Parallel(n_jobs=workers)(
-            delayed(apply_function)(i, dic_bands) for i in tqdm(list_tif)
+            delayed(apply_function)(i, chain) for i in tqdm(list_tif)
         )
     return 1
 
 
+def select_aux_files(aux_path, typeaux):
+    """Auxiliary rasters of aux_path in the order of typeaux"""
+    list_aux = glob.glob(aux_path)
+    selected = []
+    for j in typeaux:
+        found = [a for a in list_aux if basename(a)[:6] == j]
+        if len(found) == 0:
+            print(f"auxiliary data {j} not found in {aux_path}")
+            return []
+        selected.append(found[0])
+    return selected
+
+
+def fused_one_scene(
+    scene, shp_file, ouput_path, mask_path, aux_files, chain, cache_dir
+):
+    geotransform, projection, size = raster_grid(scene)
+    windows = cached_massif_windows(shp_file, geotransform, projection, size, cache_dir)
+    outputs = {
+        sta: join(ouput_path, sta + "_" + extract_date(basename(scene)) + ".tif")
+        for sta in windows
+    }
+    fused_scene_pass(scene, windows, outputs, mask_path, aux_files, chain)
+    return [o for o in outputs.values() if exists(o)]
+
+
+def data_fused(
+    data_path,
+    aux_path,
+    shp_path,
+    mask_path,
+    ouput_dir,
+    folders,
+    dic_bands,
+    typeaux,
+    add_aux,
+    mask_data,
+    workers,
+    incremental=True,
+):
+    """Mask, clip, merge and transform every scene in a single pass, only the
+    final clipped rasters per massif are written
+
+    With incremental, a manifest (ouput_dir/cache/manifest_step1.json)
+    records the content hash of the inputs (scene, auxiliary rasters, layover
+    mask, shapefile) and the parameters behind the outputs of each scene, the
+    scenes whose outputs are up to date are skipped."""
+    chain = compile_band_chain(dic_bands)
+    aux_files = select_aux_files(aux_path, typeaux) if add_aux else []
+    if add_aux and len(aux_files) == 0:
+        return 0
+    mask_path = mask_path if mask_data else None
+    common = aux_files + ([mask_path] if mask_path else [])
+    scenes = sorted(glob.glob(data_path))
+    manifest = Manifest(join(ouput_dir, "cache", "manifest_step1.json"))
+    if incremental:
+        manifest.update_hashes(scenes + common, workers)
+    for folder in folders:
+        ouput_path = join(ouput_dir, "pre_process_E0", folder)
+        makedirs(ouput_path, exist_ok=True)
+        shp_file = abspath(glob.glob(shp_path + f"{folder}/*.shp")[0])
+        params = {
+            "dic_bands": dic_bands,
+            "typeaux": typeaux if add_aux else [],
+            "mask_data": mask_data,
+            "shapefile": shapefile_hash(shp_file),
+            "ouput_path": abspath(ouput_path),
+        }
+        todo = []
+        for scene in scenes:
+            name = f"{folder}:{abspath(scene)}"
+            key = manifest.key([scene] + common, params) if incremental else None
+            if not (incremental and manifest.is_current(name, key)):
+                todo.append((name, scene, key))
+        n_done = len(scenes) - len(todo)
+        print(f"{folder}: {len(todo)} scene(s) to process, {n_done} up to date")
+        outputs = Parallel(n_jobs=workers)(
+            delayed(fused_one_scene)(
+                scene,
+                shp_file,
+                ouput_path,
+                mask_path,
+                aux_files,
+                chain,
+                join(ouput_dir, "cache"),
+            )
+            for _, scene, _ in tqdm(todo)
+        )
+        if incremental:
+            for (name, _, key), out in zip(todo, outputs):
+                manifest.record(name, key, out)
+            manifest.save()
+    return 1
+
+
 def preprocess(
     aux_path,
     data_path,
@@ -144,29 +255,64 @@ def preprocess(
     add_aux=True,
     mask_data=True,
     workers=-1,
+    fused=True,
+    incremental=True,
 ):
     print("================== Preprocessing S1 DATA ==================")
+    headers_cache = join(ouput_dir, "cache", "headers.json")
+    if fused:
+        if add_aux:
+            print("----------------------------------------------------------")
+            print("checking data and auxiliary data resolution and projection")
+            valid = check_ResProj_files(aux_path, data_path, workers, headers_cache)
+        else:
+            print("---------------------------------------")
+            print("checking data resolution and projection")
+            valid = np.array(check_data(data_path, workers, headers_cache)).size > 1
+        if valid:
+            print("------------------------------------------------------------")
+            print("masking, clipping, merging and transformation in one pass")
+            data_fused(
+                data_path,
+                aux_path,
+                shp_path,
+                mask_path,
+                ouput_dir,
+                folders,
+                dic_bands,
+                typeaux,
+                add_aux,
+                mask_data,
+                workers,
+                incremental,
+            )
+        print(
+            "================== Successfully preprocessed S1 DATA ================== "
+        )
+        return
+    if incremental:
+        print("incremental mode needs the fused stage, every scene is processed")
     if mask_data:
         print("---------------------------")
         print("masking data of the layover")
-        data_path = mask_layover(data_path, mask_path)
+        data_path = mask_layover(data_path, mask_path, workers)
     if add_aux:
         print("----------------------------------------------------------")
         print("checking data and auxiliary data resolution and projection")
-        valid = check_ResProj_files(aux_path, data_path)
+        valid = check_ResProj_files(aux_path, data_path, workers, headers_cache)
     else:
         print("---------------------------------------")
         print("checking data resolution and projection")
-        valid = np.array(check_data(data_path)).size > 1
+        valid = np.array(check_data(data_path, workers, headers_cache)).size > 1
     if valid:
         print("-------------")
         print("clipping data")
         aux_proc = False
-        data_clipping(data_path, shp_path, ouput_dir, folders, aux_proc, workers=24)
+        data_clipping(data_path, shp_path, ouput_dir, folders, aux_proc, workers)
         if add_aux:
             print("-----------------------")
             print("clipping auxiliary data")
-            data_clipping(aux_path, shp_path, ouput_dir, folders, add_aux, workers=24)
+            data_clipping(aux_path, shp_path, ouput_dir, folders, add_aux, workers)
             print("-------------------------------")
             print("merging data and auxiliary data")
             data_merge(ouput_dir, folders, typeaux)
@@ -177,7 +323,7 @@ def preprocess(
     if dic_bands != None:
         print("----------------------")
         print("transformation of data")
-        transformation_data(ouput_dir, folders, dic_bands, workers=12)
+        transformation_data(ouput_dir, folders, dic_bands, workers)
     print("================== Successfully preprocessed S1 DATA ================== ")
 
 
@@ -194,6 +340,8 @@ def main_step1(**kwargs):
         mask_data = kwargs["mask_data"]
         add_aux = kwargs["add_aux"]
         workers = kwargs["workers"]
+        fused = kwargs.get("fused", True)
+        incremental = kwargs.get("incremental", True)
     except KeyError as e:
         print("KeyError: %s undefine" % e)
     preprocess(
@@ -208,6 +356,8 @@ def main_step1(**kwargs):
         add_aux,
         mask_data,
         workers=workers,
+        fused=fused,
+        incremental=incremental,
     )
 
 
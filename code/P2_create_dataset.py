@@ -1,44 +1,197 @@
-from joblib import Parallel, delayed
-from os import makedirs
-from os.path import join, basename, dirname
-import glob, pickle
+from joblib import Parallel, delayed, effective_n_jobs
+from os import makedirs, stat, remove, replace, utime, getpid
+from os.path import join, basename, dirname, abspath, exists, getsize, getmtime
+import glob
 from tqdm import tqdm
 from datetime import datetime
 from shutil import copyfile
+import h5py
 
-from dataset_load import save_h5_II, load_h5_II
+from dataset_load import save_h5_II, load_h5_II, merge_h5_II, build_virtual_h5
 from descriptif_data import plot_bilan
 from geo_tools import load_data
-from img_processing_II import SAR_patch_clean
+from img_processing_II import SAR_patch_extract
 from labelling_tools import *
+from manifest import Manifest, params_hash
 from yaml import safe_load
 
 
-def load_pkl(path):
-    with open(path, "rb") as f:
-        obj = pickle.load(f)
-    return obj
-
-
 def load_yaml(file_name):
     with open(file_name, "r") as f:
         opt = safe_load(f)
     return opt
 
 
-def onedate2patchslabel(i, tel, windows_size, step, start=0, outdir=None, type_d="DSC"):
-    x, _ = load_data(i)
-    patchs = np.array(SAR_patch_clean(x, windows_size, step, start), dtype=np.float32)
-    X, y = add_labels_II(patchs, i, tel, type_d)
-    if outdir:
-        np.save(join(outdir, basename(i)[:-4] + ".npy"), X)
-        np.save(join(outdir, basename(i)[:-4] + "_label.npy"), y)
+PATCH_CACHE_FIELDS = ["metadata", "topography", "physics"]
+# images extracted per worker between two evictions of the patch cache
+PATCH_CACHE_BATCH = 4
+
+
+def patch_cache_key(i, table, windows_size, step, start, type_d):
+    """Key of the patches of an image in the cache: identity (path, mtime,
+    size) of the image, extraction parameters and version of the Crocus
+    pickles of the table"""
+    st = stat(i)
+    desc = [abspath(i), st.st_mtime_ns, st.st_size, windows_size, step, start]
+    return params_hash(desc + [type_d, table["key"]])[:16]
+
+
+def patch_cache_files(cache_dir, name, key):
+    """.npy files of an entry of the cache: patches then labels"""
+    base = join(cache_dir, f"{name}_{key}")
+    return [base + ".npy"] + [f"{base}_{f}.npy" for f in PATCH_CACHE_FIELDS]
+
+
+def load_patch_cache(cache_dir, name, key):
+    """Patches and labels of an image from the cache, memory-mapped
+
+    Returns
+    -------
+    tuple
+        (X, y) as returned by add_labels_II, None if the entry is missing
+    """
+    files = patch_cache_files(cache_dir, name, key)
+    if not exists(files[0]):
+        return None
+    X = np.load(files[0], mmap_mode="r")
+    if len(X) == 0:
+        y = np.array([])
+    elif all(exists(f) for f in files[1:]):
+        y = {
+            f: np.load(p, mmap_mode="r") for f, p in zip(PATCH_CACHE_FIELDS, files[1:])
+        }
+    else:
+        return None
+    # last use of the entry, for the LRU eviction
+    utime(files[0])
     return X, y
 
 
+def save_patch_cache(cache_dir, name, key, X, y):
+    """Store the patches and labels of an image in the cache, the patches are
+    written last so that an entry is complete as soon as it exists, the
+    entries of the image with another key are removed"""
+    files = patch_cache_files(cache_dir, name, key)
+    for old in glob.glob(join(cache_dir, f"{name}_" + "[0-9a-f]" * 16 + "*.npy")):
+        if old not in files:
+            remove(old)
+    arrays = [y[f] for f in PATCH_CACHE_FIELDS] if len(X) > 0 else []
+    for path, array in zip(files[1 : 1 + len(arrays)] + files[:1], arrays + [X]):
+        tmp = f"{path}.{getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, array)
+        replace(tmp, path)
+
+
+def evict_patch_cache(cache_dir, max_bytes):
+    """Remove the least recently used entries of the cache until it holds at
+    most max_bytes
+
+    Returns
+    -------
+    int
+        size of the cache (bytes)
+    """
+    entries = {}
+    for p in glob.glob(join(cache_dir, "*.npy")):
+        base = p[:-4]
+        for f in PATCH_CACHE_FIELDS:
+            if base.endswith("_" + f):
+                base = base[: -len(f) - 1]
+        entries.setdefault(base, []).append(p)
+    last_use = {b: getmtime(b + ".npy") if exists(b + ".npy") else 0 for b in entries}
+    sizes = {b: sum(getsize(p) for p in files) for b, files in entries.items()}
+    total = sum(sizes.values())
+    for b in sorted(entries, key=last_use.get):
+        if total <= max_bytes:
+            break
+        for p in entries[b]:
+            remove(p)
+        total -= sizes[b]
+    return total
+
+
+def onedate2patchslabel(
+    i,
+    table_path,
+    windows_size,
+    step,
+    start=0,
+    outdir=None,
+    type_d="DSC",
+    shard_dir=None,
+):
+    """Extract and label the patches of one image, the patches are written
+    in a hdf5 shard of the image if shard_dir is given
+
+    If outdir is given, it is used as a cache of the patches and labels of
+    the images (see patch_cache_key), an image already in the cache is not
+    read again.
+
+    Returns
+    -------
+    str or np.array
+        path of the shard (None if no patch) if shard_dir is given, patches otherwise
+    int or dict
+        number of patches if shard_dir is given, labels otherwise
+    """
+    table = load_crocus_table(table_path)
+    cached = None
+    if outdir:
+        name = basename(i)[:-4]
+        key = patch_cache_key(i, table, windows_size, step, start, type_d)
+        cached = load_patch_cache(outdir, name, key)
+    if cached is None:
+        x, _ = load_data(i)
+        patchs = SAR_patch_extract(x, windows_size, step, start)
+        X, y = add_labels_II(patchs, i, table, type_d)
+        if outdir:
+            save_patch_cache(outdir, name, key, X, y)
+    else:
+        X, y = cached
+    if shard_dir is None:
+        return X, y
+    if len(X) == 0:
+        return None, 0
+    shard = join(shard_dir, basename(i)[:-4] + ".h5")
+    save_h5_II(X, y, shard)
+    return shard, len(X)
+
+
 def create_dataset(
-    path, output_dir, folders, csv_GT, winsize, step, type_d, workers, save=True
+    path,
+    output_dir,
+    folders,
+    csv_GT,
+    winsize,
+    step,
+    type_d,
+    workers,
+    save=True,
+    incremental=True,
+    cache_size=20 * 2**30,
 ):
+    """Extract and label the patches of every image in a hdf5 shard per
+    image, gathered in a virtual dataset
+
+    The patches and labels of every image are kept in output_dir/temp/patches
+    (see onedate2patchslabel), so that an interrupted run restarts from the
+    images already extracted. The images are extracted by batches of
+    PATCH_CACHE_BATCH images per worker and the cache is brought back within
+    cache_size bytes after each batch.
+    :info: during a batch the cache can exceed cache_size by the patches of
+    the images of the batch
+
+    With incremental, a manifest (output_dir/temp/manifest_step2.json)
+    records the content hash of the image and of the Crocus pickles and the
+    extraction parameters behind each shard, only the new or modified
+    images are extracted. The manifest is saved after each batch.
+
+    Returns
+    -------
+    list
+        paths of the shards of the current images
+    """
     print("================== Create Dataset ==================")
     print("crop original images and select the non-nan results")
     print("====================================================")
@@ -48,28 +201,119 @@ def create_dataset(
     makedirs(output_path_save, exist_ok=True)
     out_temp = join(output_dir, "temp")
     makedirs(out_temp, exist_ok=True)
+    cache_dir = join(out_temp, "patches")
+    makedirs(cache_dir, exist_ok=True)
+    manifest = Manifest(join(out_temp, "manifest_step2.json"))
+    params = {"winsize": winsize, "step": step, "start": start, "type_d": type_d}
 
+    all_shards = []
     for folder in folders[:2]:
         input_path = join(path, folder, "*.tif")
-        tel = [load_pkl(csv_GT[m]) for m in range(len(csv_GT))]
-        extraction = Parallel(n_jobs=workers)(
-            delayed(onedate2patchslabel)(i, tel, winsize, step, start, out_temp, type_d)
-            for i in tqdm(glob.glob(input_path), position=0, leave=False)
-        )
+        shard_dir = join(output_path_save, f"shards_{type_d}", folder)
+        makedirs(shard_dir, exist_ok=True)
+        table_path = prepare_crocus_table(csv_GT, join(out_temp, "crocus_table"))
+        images = sorted(glob.glob(input_path))
+        if incremental:
+            manifest.update_hashes(images + list(csv_GT), workers)
+        todo, keys = [], {}
+        for i in images:
+            keys[i] = manifest.key([i] + list(csv_GT), params) if incremental else None
+            if not (incremental and manifest.is_current(abspath(i), keys[i])):
+                todo.append(i)
+        print(f"{len(todo)} image(s) to extract, {len(images) - len(todo)} up to date")
+        batch_size = PATCH_CACHE_BATCH * effective_n_jobs(workers)
+        with Parallel(n_jobs=workers) as parallel, tqdm(
+            total=len(todo), position=0, leave=False
+        ) as pbar:
+            for b in range(0, len(todo), batch_size):
+                batch = todo[b : b + batch_size]
+                extraction = parallel(
+                    delayed(onedate2patchslabel)(
+                        i,
+                        table_path,
+                        winsize,
+                        step,
+                        start,
+                        cache_dir,
+                        type_d,
+                        shard_dir,
+                    )
+                    for i in batch
+                )
+                evict_patch_cache(cache_dir, cache_size)
+                for i, (shard, n) in zip(batch, extraction):
+                    manifest.record(abspath(i), keys[i], [shard] if n > 0 else [], n=n)
+                if incremental:
+                    manifest.save()
+                pbar.update(len(batch))
+        entries = [manifest.entries.get(abspath(i), {"n": 0}) for i in images]
+        shards = [e["outputs"][0] for e in entries if e["n"] > 0]
+        all_shards += shards
 
-        X, Y = select_non_empty_list(extraction)
-
-        print("X :", X.shape, " Y :", Y.keys(), len(Y[list(Y.keys())[0]]))
+        print("samples :", sum(e["n"] for e in entries), " shards :", len(shards))
         print("=============== Done ===============")
 
-        if save:
+        if save and len(shards) > 0:
             print("=============== Save ===============")
             print(f"save dataset {folder} to hdf5 file")
             print("===================================")
             output_path_z = join(output_path_save, f"data_{type_d}_VX.h5")
-            save_h5_II(X, Y, output_path_z)
+            build_virtual_h5(shards, output_path_z)
             print("============== Done ===============")
-    return 1
+    return all_shards
+
+
+def merge_dataset(shards, acquisitions, filename, incremental=True):
+    """Merge the shards of the orbits in the final hdf5 file
+
+    With incremental, a manifest (filename.manifest.json) records the shards
+    already merged, the new shards are appended to the file. The file is
+    rebuilt when a merged shard was modified or removed, or when the file
+    does not hold the number of samples recorded.
+
+    Parameters
+    ----------
+    shards : list
+        paths of the shards
+    acquisitions : list
+        type of acquisition (ASC or DSC) of each shard
+    filename : str
+        path of the merged hdf5 file
+
+    Returns
+    -------
+    int
+        number of samples in the merged file
+    """
+    manifest = Manifest(filename + ".manifest.json")
+    manifest.update_hashes(shards)
+    keys = {
+        s: manifest.key([s], {"acquisition": a}) for s, a in zip(shards, acquisitions)
+    }
+    rebuild = not (incremental and exists(filename))
+    if not rebuild:
+        rebuild = any(keys.get(s) != e["key"] for s, e in manifest.entries.items())
+        with h5py.File(filename, "r") as hf:
+            rebuild |= len(hf["img"]) != manifest.info.get("n_samples")
+    if rebuild:
+        manifest.entries = {}
+    new = [(s, a) for s, a in zip(shards, acquisitions) if s not in manifest.entries]
+    print(
+        f"merge {len(new)} shard(s) in {filename}" + (" (rebuild)" if rebuild else "")
+    )
+    n = manifest.info.get("n_samples", 0)
+    if len(new) > 0:
+        n = merge_h5_II(
+            [s for s, _ in new],
+            filename,
+            acquisitions=[a for _, a in new],
+            mode="w" if rebuild else "a",
+        )
+        for s, _ in new:
+            manifest.record(s, keys[s], [filename])
+    manifest.info["n_samples"] = n
+    manifest.save()
+    return n
 
 
 def main_step2(**kwargs):
@@ -83,8 +327,10 @@ def main_step2(**kwargs):
     workers = kwargs["workers"]
     input_path = join(ouput_stor, "pre_process_E0")
     type_d = kwargs["type_d"]
+    incremental = kwargs.get("incremental", True)
+    cache_size = int(kwargs.get("patch_cache_gb", 20) * 2**30)
 
-    create_dataset(
+    return create_dataset(
         input_path,
         ouput_dir,
         folders,
@@ -94,6 +340,8 @@ def main_step2(**kwargs):
         type_d,
         workers,
         save,
+        incremental,
+        cache_size,
     )
 
 
@@ -107,7 +355,7 @@ if "__main__" == __name__:
     makedirs(parameter["ouput_dir"], exist_ok=True)
     now = datetime.now().strftime("%d%m%y_%HH%MM%S")
     copyfile(yaml_param, join(parameter["ouput_dir"], f"load_{now}.yml"))
-    main_step2(**parameter)
+    shards_dsc = main_step2(**parameter)
 
     #### ASCENDING DATA ####
     yaml_param2 = "parameter/Y_dataset_parameter_ASC.yml"
@@ -115,33 +363,17 @@ if "__main__" == __name__:
     makedirs(parameter2["ouput_dir"], exist_ok=True)
     now = datetime.now().strftime("%d%m%y_%HH%MM%S")
     copyfile(yaml_param2, join(parameter2["ouput_dir"], f"load_{now}.yml"))
-    main_step2(**parameter2)
+    shards_asc = main_step2(**parameter2)
 
     #### MERGE DATA ####
-    path_asc = parameter2["ouput_dir"]
-    path_desc = parameter["ouput_dir"]
-    Xa, ya = load_h5_II(join(path_asc, "final_E4", "data_ASC_VX.h5"))
-    Xd, yd = load_h5_II(join(path_desc, "final_E4", "data_DSC_VX.h5"))
-    ya["metadata"] = np.hstack(
-        [ya["metadata"], np.array(len(ya["metadata"]) * ["ASC"]).reshape(-1, 1)]
-    )
-    yd["metadata"] = np.hstack(
-        [yd["metadata"], np.array(len(yd["metadata"]) * ["DSC"]).reshape(-1, 1)]
-    )
-
-    XX = np.vstack([Xa, Xd])
-    yy = {
-        "metadata": np.vstack([ya["metadata"], yd["metadata"]]),
-        "topography": np.vstack([ya["topography"], yd["topography"]]),
-        "physics": np.vstack([ya["physics"], yd["physics"]]),
-    }
-    yy["metadata"] = yy["metadata"].astype(np.string_)
-
     data_final = join(path_final, name_dataset)
     print(data_final)
     makedirs(path_final, exist_ok=True)
-    save_h5_II(XX, yy, data_final)
-    del XX, yy, Xa, ya, Xd, yd
+    merge_dataset(
+        shards_asc + shards_dsc,
+        ["ASC"] * len(shards_asc) + ["DSC"] * len(shards_dsc),
+        data_final,
+    )
 
     #### DESCRIPTIF ####
     XX, yy = load_h5_II(data_final)
@@ -0,0 +1,127 @@
+from os.path import join, getsize
+from tempfile import TemporaryDirectory
+import numpy as np
+import pandas as pd
+import h5py
+import time
+
+from dataset_load import save_h5_II, read_rows_h5
+
+
+def synthetic_dataset(n_samples, seed=42):
+    """Synthetic dataset with the shapes and the value ranges of the real one
+
+    Parameters
+    ----------
+    n_samples : int
+        number of samples
+    seed : int, optional
+        seed of the generator, by default 42
+
+    Returns
+    -------
+    np.array
+        samples (n_samples, 15, 15, 9) in float32
+    dict
+        metadata, topography and physics of the samples
+    """
+    rng = np.random.default_rng(seed)
+    X = np.empty((n_samples, 15, 15, 9), dtype=np.float32)
+    X[..., :2] = rng.lognormal(-3, 1, (n_samples, 15, 15, 2))
+    X[..., 2] = X[..., 0] / X[..., 1]
+    X[..., 3] = rng.normal(1800, 600, (n_samples, 1, 1)) + rng.normal(
+        0, 30, (n_samples, 15, 15)
+    )
+    X[..., 4] = rng.uniform(0, 360, (n_samples, 15, 15))
+    X[..., 5] = rng.uniform(0, 60, (n_samples, 15, 15))
+    X[..., 6:] = rng.lognormal(0, 0.5, (n_samples, 15, 15, 3))
+    dates = pd.date_range("2020-08-01", "2021-08-31", freq="6D").strftime("%Y%m%d")
+    massifs = np.array(["ARAVIS", "BAUGES", "BEAUFORTAIN", "CHARTREUSE", "VERCORS"])
+    metadata = np.stack(
+        [
+            rng.choice(np.array(dates), n_samples),
+            rng.choice(massifs, n_samples),
+            rng.choice(np.array(["ASC", "DSC"]), n_samples),
+        ],
+        1,
+    ).astype(np.string_)
+    y = {
+        "metadata": metadata,
+        "topography": rng.uniform(0, 3000, (n_samples, 3)).astype(np.float32),
+        "physics": rng.uniform(0, 10, (n_samples, 3)).astype(np.float32),
+    }
+    return X, y
+
+
+def benchmark_layout(X, y, path, chunks, codec, n_random=2048, seed=42):
+    """Write the dataset with a chunk layout and a codec and measure the
+    size of the file and the throughputs
+
+    Parameters
+    ----------
+    X : np.array
+        samples to write
+    y : dict
+        metadata, topography and physics of the samples
+    path : str
+        path of the hdf5 file to write
+    chunks : int or tuple
+        layout of the chunks (see save_h5_II)
+    codec : str
+        name of the codec (see dataset_load.H5_CODECS)
+    n_random : int, optional
+        number of samples read at random positions, by default 2048
+    seed : int, optional
+        seed of the random positions, by default 42
+
+    Returns
+    -------
+    dict
+        size (MB) and write, sequential read and random read throughputs (MB/s)
+    """
+    mb = X.nbytes / 2**20
+    t = time.perf_counter()
+    save_h5_II(X, y, path, chunks=chunks, codec=codec)
+    t_write = time.perf_counter() - t
+
+    with h5py.File(path, "r") as hf:
+        t = time.perf_counter()
+        hf["img"][:]
+        t_seq = time.perf_counter() - t
+        chunk_shape = hf["img"].chunks
+
+    idx = np.random.default_rng(seed).choice(len(X), n_random, replace=False)
+    with h5py.File(path, "r") as hf:
+        t = time.perf_counter()
+        read_rows_h5(hf["img"], idx)
+        t_rand = time.perf_counter() - t
+    mb_rand = n_random * X[0].nbytes / 2**20
+    return {
+        "chunks": str(chunk_shape),
+        "codec": codec,
+        "size (MB)": round(getsize(path) / 2**20, 2),
+        "write (MB/s)": round(mb / t_write, 1),
+        "sequential read (MB/s)": round(mb / t_seq, 1),
+        "random read (MB/s)": round(mb_rand / t_rand, 1),
+    }
+
+
+def benchmark(n_samples, list_chunks, list_codecs, n_random=2048):
+    X, y = synthetic_dataset(n_samples)
+    results = []
+    with TemporaryDirectory() as tmp:
+        for chunks in list_chunks:
+            for codec in list_codecs:
+                path = join(tmp, "bench.h5")
+                results.append(benchmark_layout(X, y, path, chunks, codec, n_random))
+                print(results[-1])
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    n_samples = 50000
+    list_chunks = [None, 16, 64, 256]
+    list_codecs = ["none", "lzf", "gzip1", "gzip", "shuffle_gzip1", "shuffle_gzip"]
+
+    results = benchmark(n_samples, list_chunks, list_codecs)
+    print(results.to_string(index=False))
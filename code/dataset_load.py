@@ -1,9 +1,69 @@
+from os.path import exists, join, getsize, relpath, dirname, abspath
+from os import makedirs, stat, replace, rename, getpid
+from shutil import rmtree
 import pandas as pd
 import numpy as np
+import json
 import h5py
 
+from query_index import QueryIndex, normalise_condition
+from collections import OrderedDict
 
-def save_h5_II(img, y, filename, additional_info=True):
+INDEX_VERSION = 1
+LAYOUT_VERSION = 2
+H5_CODECS = {
+    "none": {},
+    "gzip": {"compression": "gzip"},
+    "gzip1": {"compression": "gzip", "compression_opts": 1},
+    "gzip9": {"compression": "gzip", "compression_opts": 9},
+    "shuffle_gzip": {"compression": "gzip", "shuffle": True},
+    "shuffle_gzip1": {"compression": "gzip", "compression_opts": 1, "shuffle": True},
+    "lzf": {"compression": "lzf"},
+    "shuffle_lzf": {"compression": "lzf", "shuffle": True},
+}
+
+
+def h5_storage_options(shape, chunks=None, codec="gzip"):
+    """Options of h5py.create_dataset for the chunk layout and the codec
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the dataset
+    chunks : int or tuple, optional
+        layout of the chunks, by default None (automatic chunking of h5py)
+        :info: an integer gives the number of samples per chunk, each chunk
+        holding full samples (n, 15, 15, 9)
+    codec : str or dict, optional
+        name of the codec in H5_CODECS or options of create_dataset,
+        by default "gzip"
+
+    Returns
+    -------
+    dict
+        keyword arguments of h5py.create_dataset
+    """
+    if isinstance(codec, str):
+        if codec not in H5_CODECS:
+            raise ValueError(f"unknown codec {codec}, choose in {list(H5_CODECS)}")
+        codec = H5_CODECS[codec]
+    options = dict(codec)
+    if isinstance(chunks, (int, np.integer)) and not isinstance(chunks, bool):
+        chunks = (int(max(min(chunks, shape[0]), 1)),) + tuple(shape[1:])
+    if chunks is not None:
+        options["chunks"] = chunks
+    return options
+
+
+def save_h5_II(
+    img,
+    y,
+    filename,
+    additional_info=True,
+    layout=LAYOUT_VERSION,
+    chunks=None,
+    codec="gzip",
+):
     """Save data in hdf5 format with a data part (in float32),
     a metadata part to describe data and two additional fields  (topography and physics)
 
@@ -18,16 +78,30 @@ def save_h5_II(img, y, filename, additional_info=True):
         path to save the data
     additional_info : bool, optional
         give the possibility to save additional information (topography and physics), by default True
+    layout : int, optional
+        version of the layout of the metadata, by default LAYOUT_VERSION
+        :info: 1 stores the metadata as a fixed-width string matrix, 2 stores
+        each column as integer codes (categories) or days since 1970-01-01
+        (dates) in the group "metadata", see write_metadata_h5
+    chunks : int or tuple, optional
+        layout of the chunks of "img", by default None (automatic chunking)
+        :info: an integer gives the number of samples per chunk
+    codec : str or dict, optional
+        compression of "img", name in H5_CODECS or options of
+        h5py.create_dataset, by default "gzip"
     """
     metadata = y["metadata"]
     if additional_info:
         topo = y["topography"]
         label = y["physics"]
     with h5py.File(filename, "w") as hf:
-        hf.create_dataset("img", np.shape(img), compression="gzip", data=img)
         hf.create_dataset(
-            "metadata", np.shape(metadata), compression="gzip", data=metadata
+            "img",
+            np.shape(img),
+            data=img,
+            **h5_storage_options(np.shape(img), chunks, codec),
         )
+        write_metadata_h5(hf, metadata, layout)
         if additional_info:
             hf.create_dataset(
                 "topography", np.shape(topo), compression="gzip", data=topo
@@ -41,12 +115,195 @@ def load_h5_II(filename):
     y = {}
     with h5py.File(filename, "r") as hf:
         data = np.array(hf["img"][:])
-        y["metadata"] = np.array(hf["metadata"][:]).astype(str)
+        y["metadata"] = read_metadata_h5(hf, decode=True)
         y["topography"] = np.array(hf["topography"][:]).astype(np.float32)
         y["physics"] = np.array(hf["physics"][:]).astype(np.float32)
     return data, y
 
 
+def layout_version(hf):
+    """Version of the layout of the metadata of an opened hdf5 file"""
+    return int(hf.attrs.get("layout_version", 1))
+
+
+def write_metadata_h5(hf, metadata, layout=LAYOUT_VERSION):
+    """Write the metadata part in an opened hdf5 file
+
+    Parameters
+    ----------
+    hf : h5py.File
+        hdf5 file opened in writing mode
+    metadata : np.array or list
+        metadata as a string matrix (n_samples, n_columns), or as a list of
+        encoded columns (kind, values, vocabulary) for the layout 2
+    layout : int, optional
+        version of the layout, by default LAYOUT_VERSION
+    """
+    hf.attrs["layout_version"] = layout
+    if layout == 1:
+        if isinstance(metadata, list):
+            metadata = np.stack([decode_metadata_column(*c) for c in metadata], 1)
+        metadata = np.asarray(metadata).astype(np.string_)
+        hf.create_dataset(
+            "metadata", np.shape(metadata), compression="gzip", data=metadata
+        )
+        return
+    if not isinstance(metadata, list):
+        metadata = np.asarray(metadata).reshape(len(metadata), -1)
+        metadata = [
+            encode_metadata_column(metadata[:, i]) for i in range(metadata.shape[1])
+        ]
+    grp = hf.create_group("metadata")
+    for i, (kind, values, vocab) in enumerate(metadata):
+        dset = grp.create_dataset(str(i), data=np.asarray(values), compression="gzip")
+        dset.attrs["kind"] = kind
+        dset.attrs["vocabulary"] = np.array(vocab, dtype=h5py.string_dtype())
+
+
+def read_metadata_h5(hf, idx=None, decode=False):
+    """Read the metadata part of an opened hdf5 file (layout 1 or 2)
+
+    Parameters
+    ----------
+    hf : h5py.File
+        opened hdf5 file
+    idx : np.array, optional
+        index of the rows to read, by default None (all the rows)
+    decode : bool, optional
+        return a string matrix as the layout 1, by default False
+
+    Returns
+    -------
+    list or np.array
+        columns as tuples (kind, values, vocabulary), or string matrix
+        (n_samples, n_columns) if decode is True
+    """
+    if layout_version(hf) == 1:
+        if idx is None:
+            metadata = np.array(hf["metadata"][:]).astype(str)
+        else:
+            metadata = read_rows_h5(hf["metadata"], idx, dtype=None).astype(str)
+        if decode:
+            return metadata
+        return [
+            encode_metadata_column(metadata[:, i]) for i in range(metadata.shape[1])
+        ]
+    grp = hf["metadata"]
+    columns = []
+    for i in range(len(grp)):
+        dset = grp[str(i)]
+        values = dset[:] if idx is None else read_rows_h5(dset, idx, dtype=None)
+        vocab = [
+            v.decode() if isinstance(v, bytes) else v for v in dset.attrs["vocabulary"]
+        ]
+        columns.append((dset.attrs["kind"], values, vocab))
+    if decode:
+        if len(columns) == 0:
+            return np.empty((0, 0), dtype=str)
+        return np.stack([decode_metadata_column(*c) for c in columns], 1)
+    return columns
+
+
+def plan_chunk_reads(idx, chunk_rows, max_rows=None):
+    """Plan the reading of scattered rows of a chunked dataset
+
+    The requested indices are sorted and grouped into contiguous runs of
+    chunks, so that every chunk touched by the request is read (and
+    decompressed) only once.
+
+    Parameters
+    ----------
+    idx : np.array
+        indices of the rows to read, in any order and possibly repeated
+    chunk_rows : int
+        number of rows in one chunk of the dataset
+    max_rows : int, optional
+        maximum number of rows read in one run, by default None (no limit)
+        :info: rounded down to a multiple of chunk_rows
+
+    Returns
+    -------
+    np.array
+        permutation sorting idx
+    np.array
+        sorted indices
+    list
+        runs as tuples (first row, last row + 1, start, stop) where
+        sorted[start:stop] are the indices read by the run
+    """
+    idx = np.asarray(idx, dtype=np.int64).ravel()
+    order = np.argsort(idx, kind="stable")
+    sorted_idx = idx[order]
+    if len(sorted_idx) == 0:
+        return order, sorted_idx, []
+    chunk_rows = max(int(chunk_rows), 1)
+    if max_rows is None:
+        max_chunks = np.inf
+    else:
+        max_chunks = max(int(max_rows) // chunk_rows, 1)
+    chunk_id = sorted_idx // chunk_rows
+    # boundaries where the request jumps over at least one untouched chunk
+    cut = np.flatnonzero(np.diff(chunk_id) > 1) + 1
+    bounds = np.concatenate([[0], cut, [len(sorted_idx)]])
+    runs = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        first, last = chunk_id[a], chunk_id[b - 1]
+        while first <= last:
+            stop_chunk = min(last, first + max_chunks - 1)
+            stop = a + np.searchsorted(chunk_id[a:b], stop_chunk, side="right")
+            runs.append(
+                (int(first * chunk_rows), int((stop_chunk + 1) * chunk_rows), a, stop)
+            )
+            a, first = stop, stop_chunk + 1
+            if a < b:
+                first = max(first, chunk_id[a])
+    return order, sorted_idx, runs
+
+
+def read_rows_h5(dset, idx, dtype=np.float32, max_block_bytes=256 * 2**20):
+    """Read scattered rows of a hdf5 dataset chunk by chunk
+
+    Each touched chunk is decompressed once, the rows are scattered into
+    a preallocated output which keeps the order of idx.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        dataset to read along its first axis
+    idx : np.array
+        indices of the rows to read
+    dtype : np.dtype, optional
+        type of the output, by default np.float32
+        :info: use None to keep the type of the dataset
+    max_block_bytes : int, optional
+        maximum size of a block read in one call, by default 256MB
+
+    Returns
+    -------
+    np.array
+        rows of the dataset in the order of idx
+    """
+    idx = np.asarray(idx, dtype=np.int64).ravel()
+    if dtype is None:
+        dtype = dset.dtype
+    out = np.empty((len(idx),) + dset.shape[1:], dtype=dtype)
+    if len(idx) == 0:
+        return out
+    if idx.min() < 0 or idx.max() >= dset.shape[0]:
+        raise IndexError(f"index out of range for dataset of size {dset.shape[0]}")
+    chunk_rows = dset.chunks[0] if dset.chunks is not None else 1024
+    row_bytes = max(int(np.prod(dset.shape[1:])) * dset.dtype.itemsize, 1)
+    max_rows = max(max_block_bytes // row_bytes, chunk_rows)
+    order, sorted_idx, runs = plan_chunk_reads(idx, chunk_rows, max_rows)
+    for first, last, a, b in runs:
+        # shrink the block to the rows really needed inside the run
+        first = max(first, int(sorted_idx[a]))
+        last = min(last, int(sorted_idx[b - 1]) + 1)
+        block = dset[first:last]
+        out[order[a:b]] = block[sorted_idx[a:b] - first]
+    return out
+
+
 def load_data_h5(filename, idx=None):
     """Load the dataset part of the hdf5 file
 
@@ -64,7 +321,7 @@ def load_data_h5(filename, idx=None):
     """
     with h5py.File(filename, "r") as hf:
         if idx is not None:
-            return np.array(hf["img"][idx]).astype(np.float32)
+            return read_rows_h5(hf["img"], idx, dtype=np.float32)
         else:
             return np.array(hf["img"][:]).astype(np.float32)
 
@@ -88,7 +345,7 @@ def load_info_h5(filename, idx=None, type_metadata="str"):
         metadata in the type_metadata format
     """
     with h5py.File(filename, "r") as hf:
-        metadata = np.array(hf["metadata"][:]).astype(type_metadata)
+        metadata = read_metadata_h5(hf, decode=True).astype(type_metadata)
         try:
             topography = np.array(hf["topography"][:]).astype(np.float32)
             physics = np.array(hf["physics"][:]).astype(np.float32)
@@ -105,8 +362,630 @@ def load_info_h5(filename, idx=None, type_metadata="str"):
         return metadata, topography, physics
 
 
+def read_info_rows_h5(hf, idx):
+    """Read the informations part of an opened hdf5 file for some rows
+
+    Parameters
+    ----------
+    hf : h5py.File
+        opened hdf5 file
+    idx : np.array
+        index of the rows to read
+
+    Returns
+    -------
+    dict
+        metadata (str), topography and physics (float32) of the rows
+    """
+    y = {"metadata": read_metadata_h5(hf, idx, decode=True)}
+    for key in ["topography", "physics"]:
+        if key in hf:
+            y[key] = read_rows_h5(hf[key], idx, dtype=np.float32)
+        else:
+            y[key] = np.array([None] * len(idx))
+    return y
+
+
+def read_info_rows_index(index, idx):
+    """Read the informations of some rows from the metadata index (see
+    load_info_index), same result as read_info_rows_h5 without reading the
+    hdf5 file
+
+    Parameters
+    ----------
+    index : tuple
+        metadata columns, topography and physics of load_info_index
+    idx : np.array
+        index of the rows to read
+
+    Returns
+    -------
+    dict
+        metadata (str), topography and physics (float32) of the rows
+    """
+    columns, topography, physics = index
+    idx = np.asarray(idx, dtype=np.int64)
+    if len(columns) == 0:
+        metadata = np.empty((len(idx), 0), dtype=str)
+    else:
+        metadata = np.stack(
+            [decode_metadata_column(k, np.asarray(v)[idx], c) for k, v, c in columns],
+            1,
+        )
+    y = {"metadata": metadata}
+    for key, extra in [("topography", topography), ("physics", physics)]:
+        if extra is None:
+            y[key] = np.array([None] * len(idx))
+        else:
+            y[key] = np.asarray(extra[idx], dtype=np.float32)
+    return y
+
+
+def encode_metadata_column(column):
+    """Encode a column of the metadata in a compact typed format
+
+    Parameters
+    ----------
+    column : np.array
+        column of the metadata (str or bytes)
+
+    Returns
+    -------
+    str
+        kind of the column: "date" (YYYYMMDD) or "category"
+    np.array
+        number of days since 1970-01-01 (int32) for a date, codes of the
+        vocabulary (smallest integer type) for a category
+    list
+        vocabulary of the category (sorted), empty for a date
+    """
+    column = np.asarray(column)
+    if column.dtype.kind == "S":
+        column = column.astype(str)
+    vocab, codes = np.unique(column, return_inverse=True)
+    is_date = (
+        len(vocab) > 0
+        and np.all(np.char.str_len(vocab) == 8)
+        and np.all(np.char.isdigit(vocab))
+    )
+    if is_date:
+        days = pd.to_datetime(vocab, format="%Y%m%d").values.astype("datetime64[D]")
+        return "date", days.astype(np.int32)[codes], []
+    code_type = np.min_scalar_type(max(len(vocab) - 1, 0))
+    return "category", codes.astype(code_type), vocab.tolist()
+
+
+def decode_metadata_column(kind, values, vocabulary=None):
+    """Decode a column encoded by encode_metadata_column into str
+
+    Parameters
+    ----------
+    kind : str
+        kind of the column: "date" or "category"
+    values : np.array
+        days (date) or codes (category) of the column
+    vocabulary : list, optional
+        vocabulary of the category, by default None
+
+    Returns
+    -------
+    np.array
+        decoded column (str)
+    """
+    uniq, inv = np.unique(np.asarray(values), return_inverse=True)
+    if kind == "date":
+        words = pd.to_datetime(uniq.astype("datetime64[D]")).strftime("%Y%m%d")
+        words = np.array(words, dtype=str)
+    else:
+        words = np.array(vocabulary, dtype=str)[uniq]
+    return words[inv]
+
+
+def index_path(filename):
+    """Path of the metadata index sidecar of a hdf5 file"""
+    return filename + ".index"
+
+
+def build_info_index(filename):
+    """Build the columnar index of the informations part of a hdf5 file,
+    stored next to the file: one .npy file per column (categorical codes,
+    int32 days and float32) and an index.json describing the columns
+
+    Parameters
+    ----------
+    filename : str
+        path to the hdf5 file
+
+    Returns
+    -------
+    str
+        path to the index directory
+    """
+    path = index_path(filename)
+    # built in a temporary directory moved into place once complete, so that
+    # a reader never sees a partial index
+    tmp = f"{path}.{getpid()}.tmp"
+    rmtree(tmp, ignore_errors=True)
+    makedirs(tmp)
+    infos = {
+        "version": INDEX_VERSION,
+        "mtime": stat(filename).st_mtime_ns,
+        "size": getsize(filename),
+        "columns": [],
+    }
+    try:
+        with h5py.File(filename, "r") as hf:
+            for i, (kind, values, vocab) in enumerate(read_metadata_h5(hf)):
+                np.save(join(tmp, f"metadata_{i}.npy"), values)
+                infos["columns"].append({"kind": kind, "vocabulary": vocab})
+            infos["additional_info"] = ("topography" in hf) and ("physics" in hf)
+            if infos["additional_info"]:
+                for key in ["topography", "physics"]:
+                    np.save(join(tmp, f"{key}.npy"), hf[key][:].astype(np.float32))
+        with open(join(tmp, "index.json"), "w") as f:
+            json.dump(infos, f)
+    except BaseException:
+        rmtree(tmp, ignore_errors=True)
+        raise
+    try:
+        replace(tmp, path)
+    except OSError:
+        # an index is already there (outdated, or built by another process)
+        old = f"{path}.{getpid()}.old"
+        try:
+            rename(path, old)
+        except FileNotFoundError:
+            pass
+        try:
+            replace(tmp, path)
+        except OSError:
+            # another process has just moved its index into place
+            rmtree(tmp, ignore_errors=True)
+        rmtree(old, ignore_errors=True)
+    return path
+
+
+def index_is_valid(filename):
+    """Check if the index sidecar of a hdf5 file exists and is up to date"""
+    path = join(index_path(filename), "index.json")
+    if not exists(path):
+        return False
+    try:
+        with open(path, "r") as f:
+            infos = json.load(f)
+    except ValueError:
+        return False
+    return (
+        infos.get("version") == INDEX_VERSION
+        and infos.get("mtime") == stat(filename).st_mtime_ns
+        and infos.get("size") == getsize(filename)
+    )
+
+
+def load_info_index(filename, rebuild=False):
+    """Load the columnar index of a hdf5 file (memory-mapped), the index is
+    (re)built if it is missing or if the hdf5 file changed
+
+    Parameters
+    ----------
+    filename : str
+        path to the hdf5 file
+    rebuild : bool, optional
+        force the rebuilding of the index, by default False
+
+    Returns
+    -------
+    list
+        metadata columns as tuples (kind, values, vocabulary)
+    np.array
+        topography (float32) or None
+    np.array
+        physics (float32) or None
+    """
+    if rebuild or not index_is_valid(filename):
+        build_info_index(filename)
+    path = index_path(filename)
+    with open(join(path, "index.json"), "r") as f:
+        infos = json.load(f)
+    columns = [
+        (
+            c["kind"],
+            np.load(join(path, f"metadata_{i}.npy"), mmap_mode="r"),
+            c["vocabulary"],
+        )
+        for i, c in enumerate(infos["columns"])
+    ]
+    if infos["additional_info"]:
+        topography = np.load(join(path, "topography.npy"), mmap_mode="r")
+        physics = np.load(join(path, "physics.npy"), mmap_mode="r")
+    else:
+        topography, physics = None, None
+    return columns, topography, physics
+
+
+def metadata_structure_h5(hf, chunk_rows=2**16):
+    """Kinds and vocabularies of the metadata columns of an opened hdf5 file,
+    read chunk by chunk for the layout 1
+
+    Returns
+    -------
+    list
+        kind of each column
+    list
+        vocabulary (set of words) of each column, empty for a date
+    """
+    if layout_version(hf) != 1:
+        grp = hf["metadata"]
+        kinds = [grp[str(i)].attrs["kind"] for i in range(len(grp))]
+        columns = read_metadata_h5(hf, np.arange(0))
+        return kinds, [set(c[2]) for c in columns]
+    n, k = hf["metadata"].shape
+    vocabs = [set() for _ in range(k)]
+    for a in range(0, n, chunk_rows):
+        metadata = read_metadata_h5(hf, np.arange(a, min(a + chunk_rows, n)), True)
+        for i in range(k):
+            vocabs[i].update(np.unique(metadata[:, i]).tolist())
+    kinds = [encode_metadata_column(np.array(sorted(v), dtype=str))[0] for v in vocabs]
+    vocabs = [set() if kind == "date" else v for kind, v in zip(kinds, vocabs)]
+    return kinds, vocabs
+
+
+def sources_structure_h5(sources, acquisitions=None):
+    """Common structure of several hdf5 datasets to merge
+
+    Parameters
+    ----------
+    sources : list
+        paths of the hdf5 files (layout 1 or 2)
+    acquisitions : list, optional
+        type of acquisition of each source, added as a new column of the
+        metadata, by default None
+
+    Returns
+    -------
+    list
+        kind of each metadata column
+    list
+        union of the vocabularies of each metadata column
+    tuple
+        shape of a sample
+    bool
+        True if all the sources have the topography and the physics
+    """
+    if acquisitions is not None and len(acquisitions) != len(sources):
+        raise ValueError("one type of acquisition is needed per source")
+    kinds, vocabs, shape, additional = None, None, None, True
+    for src in sources:
+        with h5py.File(src, "r") as hf:
+            src_kinds, src_vocabs = metadata_structure_h5(hf)
+            if kinds is None:
+                kinds, vocabs = src_kinds, src_vocabs
+                shape = hf["img"].shape[1:]
+            elif src_kinds != kinds or hf["img"].shape[1:] != shape:
+                raise ValueError(f"{src} is not compatible with {sources[0]}")
+            else:
+                vocabs = [v | w for v, w in zip(vocabs, src_vocabs)]
+            additional &= ("topography" in hf) and ("physics" in hf)
+    if acquisitions is not None:
+        kinds = kinds + ["category"]
+        vocabs = vocabs + [set(acquisitions)]
+    return kinds, vocabs, shape, additional
+
+
+def remap_metadata_columns(columns, kinds, words):
+    """Codes of encoded metadata columns in the vocabularies of a merged file
+
+    Parameters
+    ----------
+    columns : list
+        encoded columns (kind, values, vocabulary) of a source
+    kinds : list
+        kind of each column in the merged file
+    words : list
+        vocabulary (np.array of str) of each column in the merged file
+
+    Returns
+    -------
+    list
+        values of each column in the merged file
+    """
+    codes = []
+    for i, (kind, values, vocab) in enumerate(columns):
+        if kind != kinds[i]:
+            # dates of a layout 1 column holding other words
+            vocab, values = np.unique(
+                decode_metadata_column(kind, values, vocab), return_inverse=True
+            )
+            kind = "category"
+        if kind == "category":
+            order = np.argsort(words[i])
+            remap = order[
+                np.searchsorted(words[i], np.array(vocab, dtype=str), sorter=order)
+            ]
+            values = remap[np.asarray(values, dtype=np.int64)]
+        codes.append(values)
+    return codes
+
+
+def merge_h5_II(
+    sources,
+    filename,
+    acquisitions=None,
+    chunk_rows=4096,
+    chunks=None,
+    codec="gzip",
+    mode="w",
+):
+    """Merge several hdf5 datasets (orbits, massifs, shards...) into one file,
+    chunk by chunk, the memory is bounded by chunk_rows samples
+
+    The output uses the layout 2 with resizable datasets, so that new
+    sources can be appended later (mode="a").
+
+    Parameters
+    ----------
+    sources : list
+        paths of the hdf5 files to merge (layout 1 or 2)
+    filename : str
+        path of the merged hdf5 file
+    acquisitions : list, optional
+        type of acquisition (ASC or DSC) of each source, added as a new column
+        of the metadata, by default None (no column added)
+    chunk_rows : int, optional
+        number of samples copied at once, by default 4096
+    chunks : int or tuple, optional
+        layout of the chunks of "img", by default None (automatic chunking)
+    codec : str or dict, optional
+        compression of "img", by default "gzip"
+    mode : str, optional
+        "w" to create the file, "a" to append the sources to an existing
+        merged file, by default "w"
+
+    Returns
+    -------
+    int
+        number of samples in the merged file
+    """
+    kinds, vocabs, shape, additional = sources_structure_h5(sources, acquisitions)
+
+    with h5py.File(filename, mode) as out:
+        if "img" not in out:
+            out.attrs["layout_version"] = LAYOUT_VERSION
+            out.create_dataset(
+                "img",
+                (0,) + shape,
+                maxshape=(None,) + shape,
+                dtype=np.float32,
+                **h5_storage_options((chunk_rows,) + shape, chunks or True, codec),
+            )
+            grp = out.create_group("metadata")
+            for i, (kind, vocab) in enumerate(zip(kinds, vocabs)):
+                code_type = np.int32 if kind == "date" else np.uint8
+                if len(vocab) > 256:
+                    code_type = np.min_scalar_type(len(vocab) - 1)
+                dset = grp.create_dataset(
+                    str(i), (0,), maxshape=(None,), dtype=code_type, compression="gzip"
+                )
+                dset.attrs["kind"] = kind
+                dset.attrs["vocabulary"] = np.array([], dtype=h5py.string_dtype())
+            if additional:
+                for key in ["topography", "physics"]:
+                    out.create_dataset(
+                        key,
+                        (0, 3),
+                        maxshape=(None, 3),
+                        dtype=np.float32,
+                        compression="gzip",
+                    )
+        grp = out["metadata"]
+        if len(grp) != len(kinds) or ("topography" in out) != additional:
+            raise ValueError(f"sources are not compatible with {filename}")
+        # existing codes are kept, new words are appended to the vocabularies
+        words = []
+        for i, (kind, vocab) in enumerate(zip(kinds, vocabs)):
+            dset = grp[str(i)]
+            if dset.attrs["kind"] != kind:
+                raise ValueError(f"sources are not compatible with {filename}")
+            known = [
+                v.decode() if isinstance(v, bytes) else v
+                for v in dset.attrs["vocabulary"]
+            ]
+            known = known + sorted(set(vocab) - set(known))
+            if kind == "category" and len(known) - 1 > np.iinfo(dset.dtype).max:
+                raise ValueError(f"too many categories in the column {i}")
+            dset.attrs["vocabulary"] = np.array(known, dtype=h5py.string_dtype())
+            words.append(np.array(known, dtype=str))
+
+        pos = out["img"].shape[0]
+        for s, src in enumerate(sources):
+            with h5py.File(src, "r") as hf:
+                n = hf["img"].shape[0]
+                for a in range(0, n, chunk_rows):
+                    b = min(a + chunk_rows, n)
+                    columns = read_metadata_h5(hf, np.arange(a, b))
+                    if acquisitions is not None:
+                        columns.append(
+                            (
+                                "category",
+                                np.zeros(b - a, dtype=np.uint8),
+                                [acquisitions[s]],
+                            )
+                        )
+                    end = pos + b - a
+                    for dset_name in ["img", "topography", "physics"]:
+                        if dset_name in out:
+                            out[dset_name].resize(end, axis=0)
+                            out[dset_name][pos:end] = hf[dset_name][a:b]
+                    codes = remap_metadata_columns(columns, kinds, words)
+                    for i, values in enumerate(codes):
+                        grp[str(i)].resize(end, axis=0)
+                        grp[str(i)][pos:end] = values
+                    pos = end
+    return pos
+
+
+def build_virtual_h5(sources, filename, chunk_rows=2**16):
+    """Expose several hdf5 datasets (per scene or per massif shards) as one
+    dataset, without copying the samples
+
+    "img", "topography" and "physics" are virtual datasets mapping the
+    sources, the metadata (small) are written with the layout 2 and merged
+    vocabularies. The file can be opened by Dataset_loader as any dataset.
+
+    Parameters
+    ----------
+    sources : list
+        paths of the hdf5 files (layout 1 or 2)
+    filename : str
+        path of the virtual hdf5 file, the sources are referenced relatively
+        to its directory
+    chunk_rows : int, optional
+        number of metadata rows read at once, by default 2**16
+
+    Returns
+    -------
+    int
+        number of samples of the virtual dataset
+    """
+    kinds, vocabs, shape, additional = sources_structure_h5(sources)
+    sizes = []
+    for src in sources:
+        with h5py.File(src, "r") as hf:
+            sizes.append(hf["img"].shape[0])
+    n = int(np.sum(sizes))
+    words = [np.array(sorted(v), dtype=str) for v in vocabs]
+    names = ["img"] + (["topography", "physics"] if additional else [])
+    layouts = {}
+    for name in names:
+        row_shape = shape if name == "img" else (3,)
+        layouts[name] = h5py.VirtualLayout((n,) + row_shape, dtype=np.float32)
+        pos = 0
+        for src, size in zip(sources, sizes):
+            if size > 0:
+                layouts[name][pos : pos + size] = h5py.VirtualSource(
+                    relpath(src, dirname(abspath(filename))),
+                    name,
+                    shape=(size,) + row_shape,
+                )
+            pos += size
+    with h5py.File(filename, "w") as out:
+        for name in names:
+            out.create_virtual_dataset(name, layouts[name], fillvalue=np.nan)
+        out.attrs["layout_version"] = LAYOUT_VERSION
+        out.attrs["sources"] = np.array(
+            [relpath(src, dirname(abspath(filename))) for src in sources],
+            dtype=h5py.string_dtype(),
+        )
+        grp = out.create_group("metadata")
+        for i, kind in enumerate(kinds):
+            if kind == "date":
+                code_type = np.int32
+            else:
+                code_type = np.min_scalar_type(max(len(words[i]) - 1, 0))
+            dset = grp.create_dataset(str(i), (n,), dtype=code_type, compression="gzip")
+            dset.attrs["kind"] = kind
+            dset.attrs["vocabulary"] = np.array(words[i], dtype=h5py.string_dtype())
+        pos = 0
+        for src, size in zip(sources, sizes):
+            with h5py.File(src, "r") as hf:
+                for a in range(0, size, chunk_rows):
+                    b = min(a + chunk_rows, size)
+                    columns = read_metadata_h5(hf, np.arange(a, b))
+                    codes = remap_metadata_columns(columns, kinds, words)
+                    for i, values in enumerate(codes):
+                        grp[str(i)][pos + a : pos + b] = values
+            pos += size
+    return n
+
+
+def permutation_cycles(perm):
+    """Non trivial cycles of a permutation
+
+    Parameters
+    ----------
+    perm : np.array
+        permutation of range(n)
+
+    Returns
+    -------
+    np.array
+        positions of the cycles, concatenated, every cycle following perm
+        (perm[order[i]] == order[i + 1] inside a cycle)
+    np.array
+        position in order of the first element of every cycle
+    """
+    nxt = np.asarray(perm, dtype=np.int64).tolist()
+    visited = bytearray(len(nxt))
+    order, starts = [], []
+    for s in range(len(nxt)):
+        if visited[s] or nxt[s] == s:
+            continue
+        starts.append(len(order))
+        j = s
+        while not visited[j]:
+            visited[j] = 1
+            order.append(j)
+            j = nxt[j]
+    return np.array(order, dtype=np.int64), np.array(starts, dtype=np.int64)
+
+
+def permute_inplace(array, perm, block_bytes=4 * 2**20, cycles=None):
+    """Permute the rows of an array in place, array becomes array[perm]
+
+    The cycles of the permutation are cut in segments and the segments are
+    followed together, one step of all the segments of a block at a time,
+    so that every row is moved once, by blocks of rows, and only the first
+    row of every segment is held in a buffer: the array is never copied.
+
+    Parameters
+    ----------
+    array : np.array
+        array to permute along its first axis
+    perm : np.array
+        permutation of range(len(array))
+    block_bytes : int, optional
+        size of the rows moved at each step, by default 4 MiB
+    cycles : tuple, optional
+        permutation_cycles(perm), by default None (computed)
+    """
+    order, starts = permutation_cycles(perm) if cycles is None else cycles
+    n = len(order)
+    if n == 0:
+        return
+    n_seg = max(int(block_bytes // max(array[:1].nbytes, 1)), 1)
+    size = -(-n // n_seg)
+    ends = np.append(starts[1:], n)
+    # segments of at most size positions, never across two cycles
+    count = -(-(ends - starts) // size)
+    cyc = np.repeat(np.arange(len(starts)), count)
+    seg_start = (
+        starts[cyc] + (np.arange(len(cyc)) - (np.cumsum(count) - count)[cyc]) * size
+    )
+    seg_end = np.minimum(seg_start + size, ends[cyc])
+    # the last row of a segment comes from the next one or the cycle start
+    tail = np.where(seg_end == ends[cyc], starts[cyc], seg_end)
+    carry = None
+    for b in range(0, len(seg_start), n_seg):
+        first, last = seg_start[b : b + n_seg], seg_end[b : b + n_seg]
+        src, c = tail[b : b + n_seg], cyc[b + len(first) - 1]
+        # only the cycle open at the start of the block began before it, its
+        # first row was overwritten and is carried
+        early = src < first[0]
+        heads = array[order[np.where(early, first[0], src)]]
+        if early.any():
+            heads[early] = carry
+        if last[-1] != ends[c] and starts[c] >= first[0]:
+            carry = array[order[starts[c]]].copy()
+        length = last - first
+        for r in range(int(length.max())):
+            k = np.flatnonzero(length > r + 1)
+            array[order[first[k] + r]] = array[order[first[k] + r + 1]]
+            k = np.flatnonzero(length == r + 1)
+            array[order[first[k] + r]] = heads[k]
+
+
 def shuffle_data(X, y, seed=42):
-    """Shuffle the dataset and the metadata
+    """Shuffle the dataset and the metadata in place
 
     Parameters
     ----------
@@ -114,17 +993,88 @@ def shuffle_data(X, y, seed=42):
         dataset
     y : dict
         dictionary of description of the dataset
+    seed : int, optional
+        seed of the generator, by default 42
 
     Returns
     -------
     np.array
-        shuffled dataset
+        shuffled dataset (same array as X)
     dict
-        shuffled metadata
+        shuffled metadata (same arrays as y)
+    """
+    perm = np.random.default_rng(seed).permutation(len(X))
+    cycles = permutation_cycles(perm)
+    permute_inplace(X, perm, cycles=cycles)
+    for v in y.values():
+        permute_inplace(v, perm, cycles=cycles)
+    return X, y
+
+
+class Dataset_view:
+    """Lazy view on some samples of a hdf5 dataset, the samples are read
+    (chunk by chunk, see read_rows_h5) only when they are accessed, so that
+    several views of the same file never copy the image tensor
+
+    Parameters
+    ----------
+    path : str
+        path to the hdf5 file
+    idx : np.array
+        index of the samples of the view
+    index : tuple, optional
+        metadata index of the file (see load_info_index) the labels are read
+        from, by default None (read from the hdf5 file)
     """
-    idx = np.arange(len(X))
-    np.random.shuffle(idx)
-    return X[idx], {k: v[idx] for k, v in y.items()}
+
+    def __init__(self, path, idx, index=None):
+        self.path = path
+        self.idx = np.asarray(idx, dtype=np.int64)
+        self.index = index
+        with h5py.File(path, "r") as hf:
+            self.shape = (len(self.idx),) + hf["img"].shape[1:]
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, key):
+        """Samples of the view (int, slice or array of positions in the view)
+        in float32"""
+        rows = self.idx[key]
+        with h5py.File(self.path, "r") as hf:
+            X = read_rows_h5(hf["img"], np.atleast_1d(rows))
+        return X[0] if np.ndim(rows) == 0 else X
+
+    def labels(self, key=slice(None)):
+        """Metadata, topography and physics of samples of the view"""
+        rows = np.atleast_1d(self.idx[key])
+        if self.index is not None:
+            return read_info_rows_index(self.index, rows)
+        with h5py.File(self.path, "r") as hf:
+            return read_info_rows_h5(hf, rows)
+
+    def iter_batches(self, batch_size=256):
+        """Iterate over the samples of the view by mini-batches
+
+        Yields
+        ------
+        np.array
+            batch of the dataset in float32
+        dict
+            metadata, topography and physics of the batch
+        """
+        # the chunk cache keeps the chunks shared by consecutive batches
+        with h5py.File(self.path, "r", rdcc_nbytes=64 * 2**20) as hf:
+            for s in range(0, len(self.idx), batch_size):
+                rows = self.idx[s : s + batch_size]
+                if self.index is not None:
+                    y = read_info_rows_index(self.index, rows)
+                else:
+                    y = read_info_rows_h5(hf, rows)
+                yield read_rows_h5(hf["img"], rows), y
+
+    def __repr__(self):
+        return f"Dataset_view: ({self.path}) with {len(self.idx)} samples"
 
 
 class Dataset_loader:
@@ -144,6 +1094,7 @@ class Dataset_loader:
             "hsnow",
         ],
         print_info=True,
+        cache_size=2**30,
     ):
         self.path = path
         self.descrp = descrp
@@ -152,15 +1103,47 @@ class Dataset_loader:
         self.X = None
         self.y = {}
         self.print_info = print_info
+        self.cache_size = cache_size
+        self.clear_cache()
         self.init_info()
 
     def init_info(self):
-        """Load the metadata and prepare the information for the request"""
-        temp = load_info_h5(self.path)
-        self.infos = pd.concat([pd.DataFrame(i) for i in temp], axis=1)
+        """Load the metadata and prepare the information for the request
+
+        The informations are read from the columnar index stored next to the
+        hdf5 file (built once, see build_info_index)
+        """
+        try:
+            columns, topography, physics = load_info_index(self.path)
+        except OSError as e:
+            if self.print_info:
+                print(e)
+                print("Index not writable, the metadata are decoded in memory")
+            with h5py.File(self.path, "r") as hf:
+                columns = read_metadata_h5(hf)
+                topography, physics = None, None
+                if ("topography" in hf) and ("physics" in hf):
+                    topography = hf["topography"][:].astype(np.float32)
+                    physics = hf["physics"][:].astype(np.float32)
+        data = {}
+        for kind, values, vocab in columns:
+            if kind == "date":
+                values = np.asarray(values).astype("datetime64[D]")
+                data[len(data)] = values.astype("datetime64[ns]")
+            else:
+                data[len(data)] = pd.Categorical.from_codes(values, vocab)
+        n = len(columns[0][1])
+        for extra in [topography, physics]:
+            extra = np.full((n, 3), None) if extra is None else np.asarray(extra)
+            for j in range(extra.shape[1]):
+                data[len(data)] = extra[:, j]
+        self.infos = pd.DataFrame(data)
         self.infos.columns = self.descrp
-        self.infos.date = pd.to_datetime(self.infos.date, format="%Y%m%d")
         self.idx_request = self.infos.index.values
+        self.index = (columns, topography, physics)
+        self.query_index = QueryIndex.from_info(
+            self.descrp, columns, topography, physics
+        )
 
     def check_data(self):
         """Check if the dataset and the metadata have the same dimension"""
@@ -169,38 +1152,397 @@ class Dataset_loader:
         )
 
     def load_data(self):
-        """Load the dataset and the metadata with respect to the request and shuffle the data if needed"""
-        self.X = load_data_h5(self.path, self.idx_request)
+        """Load the dataset and the metadata with respect to the request and shuffle the data if needed
+
+        The index is permuted (seeded by self.seed) before reading, so that
+        the samples are read already shuffled, chunk by chunk. The labels are
+        read the same way, only the chunks holding the requested rows are
+        decoded.
+        """
+        idx = np.asarray(self.idx_request)
+        if self.shuffle:
+            idx = np.random.default_rng(self.seed).permutation(idx)
+        with h5py.File(self.path, "r") as hf:
+            self.X = read_rows_h5(hf["img"], idx)
+            self.y = read_info_rows_h5(hf, idx)
         self.dim = self.X.shape
         print(self.dim)
-        self.y["metadata"], self.y["topography"], self.y["physics"] = load_info_h5(
-            self.path, self.idx_request
-        )
-        if self.check_data():
-            if self.shuffle:
-                self.X, self.y = shuffle_data(self.X, self.y, seed=self.seed)
-        else:
+        if not self.check_data():
             if self.print_info:
                 print("Error in dimension")
         return self.X, self.y
 
-    def request_data(self, condition):
-        """Request the dataset with respect to the condition
+    def select(self, condition):
+        """Select the index of the samples with respect to the condition,
+        without loading the data
+
+        The condition is compiled to numpy masks on the index (see
+        query_index.QueryIndex), pandas query is used for the conditions it
+        does not support.
 
         Parameters
         ----------
         condition : str
             SQL like request to select the data in the pandas dataframe
+
+        Returns
+        -------
+        np.array
+            index of the selected samples
         """
         try:
-            self.idx_request = self.infos.query(condition).index.values
+            key = self.request_key(condition)[:2]
+            if key not in self.index_cache:
+                try:
+                    idx = self.query_index.select(condition)
+                except Exception:
+                    # outside the grammar of the compiled queries
+                    idx = self.infos.query(condition).index.values
+                self.index_cache[key] = idx
+            self.idx_request = self.index_cache[key]
             if self.print_info:
                 print(f"Request: {condition} with {len(self.idx_request)} samples")
         except Exception as e:
             if self.print_info:
                 print(e)
                 print("Error in request")
-        return self.load_data()
+        return self.idx_request
+
+    def request_data(self, condition):
+        """Request the dataset with respect to the condition
+
+        The results are kept in a LRU cache within cache_size bytes, keyed by
+        the normalised condition, the identity of the file and the shuffle
+        seed (see cache_info). The cache keeps its own copy of the arrays and
+        a hit returns a new copy, so the results can be modified in place
+        (shuffle_data...) whatever their size.
+
+        Parameters
+        ----------
+        condition : str
+            SQL like request to select the data in the pandas dataframe
+        """
+        key = self.request_key(condition)
+        if key in self.request_cache:
+            self.cache_stats["hits"] += 1
+            self.request_cache.move_to_end(key)
+            X, y, _ = self.request_cache[key]
+            self.X = X.copy()
+            self.y = {k: v.copy() for k, v in y.items()}
+            self.idx_request = self.index_cache[key[:2]]
+            self.dim = self.X.shape
+            return self.X, self.y
+        self.cache_stats["misses"] += 1
+        self.select(condition)
+        self.load_data()
+        if key[:2] in self.index_cache:
+            self.cache_request(key, self.X, dict(self.y))
+        return self.X, self.y
+
+    def request_key(self, condition):
+        """Key of a request: normalised condition, identity (path, mtime and
+        size) of the file, shuffle seed"""
+        st = stat(self.path)
+        try:
+            condition = normalise_condition(condition)
+        except Exception:
+            condition = " ".join(condition.split())
+        identity = (abspath(self.path), st.st_mtime_ns, st.st_size)
+        return condition, identity, self.seed if self.shuffle else None
+
+    def cache_request(self, key, X, y):
+        """Keep a copy of the result of a request (the caller keeps the
+        arrays), the least recently used results are evicted to stay within
+        cache_size bytes"""
+        nbytes = X.nbytes + sum(np.asarray(v).nbytes for v in y.values())
+        if nbytes > self.cache_size:
+            return
+        X = X.copy()
+        y = {k: np.array(v) for k, v in y.items()}
+        # never handed out, only copied by the hits
+        X.flags.writeable = False
+        for v in y.values():
+            v.flags.writeable = False
+        self.request_cache[key] = (X, y, nbytes)
+        self.cache_stats["bytes"] += nbytes
+        while self.cache_stats["bytes"] > self.cache_size:
+            _, (_, _, n) = self.request_cache.popitem(last=False)
+            self.cache_stats["bytes"] -= n
+            self.cache_stats["evictions"] += 1
+
+    def cache_info(self):
+        """Hits, misses, evictions, bytes and entries of the request cache"""
+        return dict(
+            self.cache_stats,
+            entries=len(self.request_cache),
+            indexes=len(self.index_cache),
+            cache_size=self.cache_size,
+        )
+
+    def clear_cache(self):
+        """Empty the request cache and reset its counters"""
+        self.request_cache = OrderedDict()
+        self.index_cache = {}
+        self.cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+    def iter_batches(
+        self, condition=None, batch_size=256, shuffle=None, buffer_size=None
+    ):
+        """Iterate over the requested samples by mini-batches, reading the
+        images chunk by chunk so that the memory stays bounded by the shuffle
+        buffer, the labels are taken from the metadata index (see init_info)
+
+        Parameters
+        ----------
+        condition : str, optional
+            SQL like request to select the data, by default None (use the last request)
+        batch_size : int, optional
+            number of samples per batch, by default 256
+        shuffle : bool, optional
+            shuffle the chunks order and the samples inside the shuffle buffer,
+            by default None (use self.shuffle)
+        buffer_size : int, optional
+            number of samples kept in the shuffle buffer, by default 16 * batch_size
+
+        Yields
+        ------
+        np.array
+            batch of the dataset in float32
+        dict
+            metadata, topography and physics of the batch
+        """
+        if condition is not None:
+            self.select(condition)
+        if shuffle is None:
+            shuffle = self.shuffle
+        if buffer_size is None:
+            buffer_size = 16 * batch_size
+        if not shuffle:
+            buffer_size = 0
+        rng = np.random.default_rng(self.seed)
+        idx = np.sort(np.asarray(self.idx_request, dtype=np.int64))
+        with h5py.File(self.path, "r") as hf:
+            dset = hf["img"]
+            chunk_rows = dset.chunks[0] if dset.chunks is not None else 1024
+            blocks = np.split(idx, np.flatnonzero(np.diff(idx // chunk_rows)) + 1)
+            if shuffle:
+                blocks = [blocks[i] for i in rng.permutation(len(blocks))]
+            buf_x, buf_i, n_buf = [], [], 0
+            for n, rows in enumerate(blocks):
+                if len(rows) == 0:
+                    continue
+                buf_x.append(read_rows_h5(dset, rows))
+                buf_i.append(rows)
+                n_buf += len(rows)
+                last = n == len(blocks) - 1
+                if n_buf < buffer_size + batch_size and not last:
+                    continue
+                X, rows = np.concatenate(buf_x), np.concatenate(buf_i)
+                if shuffle:
+                    perm = rng.permutation(len(rows))
+                    X, rows = X[perm], rows[perm]
+                if last:
+                    n_out = len(rows)
+                else:
+                    n_out = (len(rows) - buffer_size) // batch_size * batch_size
+                for s in range(0, n_out, batch_size):
+                    yield X[s : s + batch_size], read_info_rows_index(
+                        self.index, rows[s : s + batch_size]
+                    )
+                buf_x, buf_i, n_buf = [X[n_out:]], [rows[n_out:]], len(rows) - n_out
+
+    def strata(self, idx, stratify_on, bins=10):
+        """Stratum of some samples for a column of the index
+
+        Parameters
+        ----------
+        idx : np.array
+            index of the samples
+        stratify_on : str
+            column of the index, every value of a categorical or date column
+            is a stratum, a numeric column is cut in bins
+        bins : int or list, optional
+            number of bins of equal width or edges of the bins, by default 10
+
+        Returns
+        -------
+        np.array
+            stratum of every sample, -1 outside the bins (or NaN)
+        list
+            description of the strata
+        """
+        values = np.asarray(self.infos[stratify_on])[idx]
+        if not np.issubdtype(values.dtype, np.number):
+            codes, uniques = pd.factorize(values)
+            return codes, [str(u) for u in uniques]
+        values = values.astype(np.float64)
+        valid = ~np.isnan(values)
+        if np.ndim(bins) == 0:
+            bins = np.histogram_bin_edges(values[valid], bins)
+        edges = np.asarray(bins, dtype=np.float64)
+        codes = np.searchsorted(edges, values, side="right") - 1
+        # the last bin is closed on the right (as np.histogram)
+        codes[valid & (values == edges[-1])] = len(edges) - 2
+        codes[~valid | (codes < 0) | (codes > len(edges) - 2)] = -1
+        labels = [f"[{a:g}, {b:g})" for a, b in zip(edges[:-1], edges[1:])]
+        return codes, labels
+
+    def sample(
+        self,
+        n,
+        stratify_on=None,
+        bins=10,
+        condition=None,
+        balanced=False,
+        weights=None,
+        replace=False,
+        seed=None,
+    ):
+        """Sample n of the requested samples and load them
+
+        The samples are chosen from the index only (metadata, topography and
+        physics), then only the chosen rows are read, chunk by chunk (see
+        read_rows_h5).
+
+        Parameters
+        ----------
+        n : int
+            number of samples
+        stratify_on : str, optional
+            column of the strata (see strata), by default None (simple random
+            sampling)
+        bins : int or list, optional
+            bins of a numeric stratify_on column, by default 10
+        condition : str, optional
+            SQL like request to select the data, by default None (use the last request)
+        balanced : bool, optional
+            same number of samples in every stratum, by default False
+            (proportional to the size of the strata)
+        weights : list or dict, optional
+            share of the samples of every stratum, in the order of strata or
+            by description of the strata, by default None
+        replace : bool, optional
+            sample with replacement, needed to balance strata smaller than
+            their share, by default False
+        seed : int, optional
+            seed of the sampling, by default None (self.seed)
+
+        Returns
+        -------
+        np.array
+            samples in float32
+        dict
+            metadata, topography and physics of the samples
+            :info: the index of the samples is kept in idx_sample, the
+            request (idx_request) is unchanged, nothing is sampled when no
+            sample is in a stratum
+            :info: raise ValueError when the weights do not match the strata
+            or select none of them
+        """
+        if condition is not None:
+            self.select(condition)
+        rng = np.random.default_rng(self.seed if seed is None else seed)
+        idx = np.asarray(self.idx_request, dtype=np.int64)
+        if stratify_on is None:
+            codes, labels = np.zeros(len(idx), dtype=np.int64), ["all"]
+        else:
+            codes, labels = self.strata(idx, stratify_on, bins)
+        sizes = np.bincount(codes[codes >= 0], minlength=len(labels))
+        if isinstance(weights, dict):
+            share = np.array([weights.get(s, 0) for s in labels], dtype=np.float64)
+        elif weights is not None:
+            share = np.asarray(weights, dtype=np.float64).ravel()
+            if len(share) != len(labels):
+                raise ValueError(f"{len(share)} weights for the strata {labels}")
+        elif balanced:
+            share = (sizes > 0).astype(np.float64)
+        else:
+            share = sizes.astype(np.float64)
+        if sizes.sum() == 0:
+            if self.print_info:
+                print("No sample to choose from")
+            return self._load_sample(np.array([], dtype=np.int64))
+        if np.any(share < 0) or share.sum() == 0:
+            raise ValueError(f"weights {weights} select none of the strata {labels}")
+        share = n * share / share.sum()
+        counts = np.floor(share).astype(np.int64)
+        # largest remainders first for the samples left by the rounding
+        left = n - counts.sum()
+        counts[np.argsort(counts - share, kind="stable")[:left]] += 1
+        if not replace:
+            counts = np.minimum(counts, sizes)
+        chosen = []
+        for s, count in enumerate(counts):
+            members = idx[codes == s]
+            if count > 0 and len(members) > 0:
+                chosen.append(rng.choice(members, count, replace=replace))
+            if self.print_info:
+                print(f"{stratify_on or 'sample'} {labels[s]}: {count}/{len(members)}")
+        chosen = np.concatenate(chosen) if chosen else np.array([], dtype=np.int64)
+        if self.print_info and len(chosen) < n:
+            print(f"Only {len(chosen)} samples available without replacement")
+        chosen = rng.permutation(chosen) if self.shuffle else np.sort(chosen)
+        return self._load_sample(chosen)
+
+    def _load_sample(self, chosen):
+        """Read the rows chosen by sample (kept in idx_sample)"""
+        self.idx_sample = chosen
+        with h5py.File(self.path, "r") as hf:
+            self.X = read_rows_h5(hf["img"], chosen)
+            self.y = read_info_rows_h5(hf, chosen)
+        self.dim = self.X.shape
+        return self.X, self.y
+
+    def group_kfold(self, k=5, group="massif", condition=None):
+        """Group K-fold split of the requested samples: all the samples of a
+        group (massif...) are in the same test fold, the groups are assigned
+        to the folds from the largest to the smallest, each time to the
+        smallest fold (as sklearn GroupKFold)
+
+        The folds are computed from the index only and returned as lazy
+        views (see Dataset_view), the image tensor is never copied.
+
+        Parameters
+        ----------
+        k : int, optional
+            number of folds, by default 5
+        group : str, optional
+            column of the groups, by default "massif"
+        condition : str, optional
+            SQL like request to select the data, by default None (use the last request)
+
+        Yields
+        ------
+        Dataset_view
+            training samples of the fold
+        Dataset_view
+            test samples of the fold
+            :info: no fold when there are less than k groups
+        """
+        if condition is not None:
+            self.select(condition)
+        idx = np.asarray(self.idx_request, dtype=np.int64)
+        codes, groups = pd.factorize(np.asarray(self.infos[group])[idx])
+        if len(groups) < k:
+            if self.print_info:
+                print(f"Cannot have {k} folds with {len(groups)} groups of {group}")
+            return
+        sizes = np.bincount(codes, minlength=len(groups))
+        fold_sizes = np.zeros(k, dtype=np.int64)
+        fold_of_group = np.zeros(len(groups), dtype=np.int64)
+        for g in np.argsort(sizes, kind="stable")[::-1]:
+            fold_of_group[g] = np.argmin(fold_sizes)
+            fold_sizes[fold_of_group[g]] += sizes[g]
+        fold = fold_of_group[codes]
+        for f in range(k):
+            if self.print_info:
+                test_groups = list(groups[fold_of_group == f])
+                print(
+                    f"Fold {f}: test {group} {test_groups} with {fold_sizes[f]} samples"
+                )
+            yield Dataset_view(self.path, idx[fold != f], self.index), Dataset_view(
+                self.path, idx[fold == f], self.index
+            )
 
     def __repr__(self):
         return f"Dataset_loader: ({self.path}) with {len(self.idx_request)} samples"
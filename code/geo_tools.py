@@ -1,15 +1,16 @@
-from osgeo_utils import gdal_merge
-from osgeo import gdal
+from osgeo import gdal, ogr, osr
 from joblib import Parallel, delayed
-from os.path import join, basename, dirname, exists
-from os import system, remove, makedirs
+from os.path import join, basename, dirname, exists, splitext
+from os import system, remove, makedirs, replace, getpid, stat
 from tqdm import tqdm
 import numpy as np
+from xml.sax.saxutils import escape
+import hashlib
+import json
 import glob
-import subprocess
 
 
-def load_data(file_name, gdal_driver="GTiff"):
+def load_data(file_name, gdal_driver="GTiff", window=None):
     """
     Converts a GDAL compatable file into a numpy array and associated geodata.
     The rray is provided so you can run with your processing - the geodata consists of the geotransform and gdal dataset object
@@ -18,6 +19,8 @@ def load_data(file_name, gdal_driver="GTiff"):
 
     VARIABLES
     file_name : file name and path of your file
+    window : (xoff, yoff, xsize, ysize) to read only a window of the file (see iter_blocks),
+             the geotransform returned is the one of the window
 
     RETURNS
     image array
@@ -37,19 +40,94 @@ def load_data(file_name, gdal_driver="GTiff"):
     projection = inDs.GetProjection()
 
     # Get the data as a numpy array
-    cols = inDs.RasterXSize
-    rows = inDs.RasterYSize
-
-    channel = inDs.RasterCount
-    image_array = np.zeros((rows, cols, channel), dtype=np.float32)
-    for i in range(channel):
-        data_array = inDs.GetRasterBand(i + 1).ReadAsArray(0, 0, cols, rows)
-        image_array[:, :, i] = data_array
+    if window is None:
+        window = (0, 0, inDs.RasterXSize, inDs.RasterYSize)
+    else:
+        geotransform = window_geotransform(geotransform, window)
+    image_array = read_block(inDs, window)
     inDs = None
     return image_array, (geotransform, projection)
 
 
-def array2raster(data_array, geodata, file_out, gdal_driver="GTiff"):
+def iter_blocks(ds, min_pixels=2**20):
+    """Windows covering a raster, aligned on its native block size
+
+    Native blocks are grouped (whole rows of blocks first) until a window
+    holds about min_pixels pixels, so that striped rasters are not read
+    line by line.
+
+    Parameters
+    ----------
+    ds : gdal.Dataset
+        opened dataset
+    min_pixels : int, optional
+        minimum number of pixels of a window, by default 2**20
+
+    Yields
+    ------
+    tuple
+        window (xoff, yoff, xsize, ysize)
+    """
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    bx, by = ds.GetRasterBand(1).GetBlockSize()
+    bx, by = min(bx, cols), min(by, rows)
+    n_blocks = max(int(np.ceil(min_pixels / (bx * by))), 1)
+    blocks_per_row = int(np.ceil(cols / bx))
+    if n_blocks >= blocks_per_row:
+        bx = cols
+        by = by * int(np.ceil(n_blocks / blocks_per_row))
+    else:
+        bx = bx * n_blocks
+    for yoff in range(0, rows, by):
+        for xoff in range(0, cols, bx):
+            yield xoff, yoff, min(bx, cols - xoff), min(by, rows - yoff)
+
+
+def read_block(ds, window):
+    """Read a window (xoff, yoff, xsize, ysize) of all the bands of a dataset
+    as an array (ysize, xsize, bands) in float32"""
+    xoff, yoff, xsize, ysize = window
+    array = np.zeros((ysize, xsize, ds.RasterCount), dtype=np.float32)
+    for i in range(ds.RasterCount):
+        array[:, :, i] = ds.GetRasterBand(i + 1).ReadAsArray(xoff, yoff, xsize, ysize)
+    return array
+
+
+def write_block(ds, array, window):
+    """Write an array (ysize, xsize, bands) in a window of an opened dataset"""
+    xoff, yoff = window[:2]
+    for i in range(array.shape[2]):
+        ds.GetRasterBand(i + 1).WriteArray(array[:, :, i], xoff, yoff)
+
+
+def create_raster_like(file_out, ds, bands=None, gdal_driver="GTiff"):
+    """Create an empty float32 raster on the grid of an opened dataset
+
+    Parameters
+    ----------
+    file_out : str
+        path of the raster to create
+    ds : gdal.Dataset
+        dataset giving the grid (size, geotransform and projection)
+    bands : int, optional
+        number of bands, by default None (same as ds)
+
+    Returns
+    -------
+    gdal.Dataset
+        dataset opened in writing mode
+    """
+    driver = gdal.GetDriverByName(gdal_driver)
+    bands = ds.RasterCount if bands is None else bands
+    outDs = driver.Create(
+        file_out, ds.RasterXSize, ds.RasterYSize, bands, gdal.GDT_Float32
+    )
+    outDs.SetGeoTransform(ds.GetGeoTransform())
+    outDs.SetProjection(ds.GetProjection())
+    return outDs
+
+
+def array2raster(data_array, geodata, file_out, gdal_driver="GTiff", nodata=None):
     """
     Converts a numpy array to a specific geospatial output
     If you provide the geodata of the original input dataset, then the output array will match this exactly.
@@ -63,6 +141,7 @@ def array2raster(data_array, geodata, file_out, gdal_driver="GTiff"):
                             see data2array()
     file_out = name of file to output to (directory must exist)
     gdal_driver = the gdal driver to use to write out the data (default is geotif) - see: http://www.gdal.org/formats_list.html
+    nodata = nodata value of the bands (default is None, no nodata value)
 
     RETURNS
     None
@@ -95,12 +174,14 @@ def array2raster(data_array, geodata, file_out, gdal_driver="GTiff"):
         # Write raster datasets
         for i in range(bands):
             outBand = outDs.GetRasterBand(i + 1)
+            if nodata is not None:
+                outBand.SetNoDataValue(nodata)
             outBand.WriteArray(data_array[:, :, i])
 
         print("Output saved: %s" % file_out)
 
 
-def mask_layover(data_path, mask_path):
+def mask_layover(data_path, mask_path, workers=-1):
     """Mask the layover pixels in the data with the mask
 
     Parameters
@@ -109,6 +190,8 @@ def mask_layover(data_path, mask_path):
         Path to the data to be masked
     mask_path : str
         Path to the mask to be used
+    workers : int, optional
+        number of parallel jobs, by default -1 (all the cores)
 
     Returns
     -------
@@ -116,37 +199,52 @@ def mask_layover(data_path, mask_path):
         Path to the masked data
     """
     data_files = glob.glob(data_path)
-    mask_img, _ = load_data(mask_path)
-    # for data_file in tqdm(data_files):
-    Parallel(n_jobs=6)(
-        delayed(mask_one_img)(data_file, mask_img) for data_file in tqdm(data_files)
+    Parallel(n_jobs=workers)(
+        delayed(mask_one_img)(data_file, mask_path) for data_file in tqdm(data_files)
     )
     new_dir = join(dirname(data_files[0]), "temp")
     return join(new_dir, "*.tif")
 
 
-def mask_one_img(data_file, mask_img):
-    im, ge = load_data(data_file)
-    for i in range(im.shape[2]):
-        im[:, :, i] = np.where(mask_img[:, :, 0] == 1, -999, im[:, :, i])
+def mask_one_img(data_file, mask_path):
+    """Mask the layover of one image block by block, the memory is bounded by
+    the size of a block
+
+    Raise ValueError (and remove the partial output) when a block of the
+    image cannot be read in the mask, e.g. a mask smaller than the image.
+    """
     new_dir = join(dirname(data_file), "temp")
-    # new_dir = join(dirname(mask_path), "temp")
     new_path = join(new_dir, basename(data_file))
     makedirs(new_dir, exist_ok=True)
-    array2raster(im, ge, new_path)
+    ds = gdal.Open(data_file, gdal.GA_ReadOnly)
+    mask_ds = gdal.Open(mask_path, gdal.GA_ReadOnly)
+    outDs = create_raster_like(new_path, ds)
+    for window in iter_blocks(ds):
+        im = read_block(ds, window)
+        mask = mask_ds.GetRasterBand(1).ReadAsArray(*window)
+        if mask is None:
+            ds = mask_ds = outDs = None
+            remove(new_path)
+            raise ValueError(
+                f"Cannot read the window {window} of {data_file} in the mask {mask_path}"
+            )
+        im[mask == 1] = -999
+        write_block(outDs, im, window)
+    ds = mask_ds = outDs = None
+    print("Output saved: %s" % new_path)
     return 1
 
 
-def linear_to_db(value, bands):
-    array = value.copy()
+def linear_to_db(value, bands, inplace=False):
+    array = value if inplace else value.copy()
     array[:, :, bands - 1] = np.where(
         value[:, :, bands - 1] <= 0, -999, 10 * np.log10(value[:, :, bands - 1])
     )
     return array
 
 
-def ref_to_ratio(value, band):
-    array = value.copy()
+def ref_to_ratio(value, band, inplace=False):
+    array = value if inplace else value.copy()
     log_data_ref = np.where(value[:, :, band - 1] <= 0, np.nan, value[:, :, band - 1])
     log_data = np.where(
         value[:, :, (band - 1) % 3] <= 0, np.nan, value[:, :, (band - 1) % 3]
@@ -160,14 +258,50 @@ def ref_to_ratio(value, band):
     return array
 
 
+BAND_FUNCTIONS = {"linear_to_db": linear_to_db, "ref_to_ratio": ref_to_ratio}
+
+
+def compile_band_chain(dic_bands):
+    """Resolve and validate the functions of dic_bands once
+
+    Parameters
+    ----------
+    dic_bands : dict or list
+        band -> name of the function in BAND_FUNCTIONS, or an already
+        compiled chain
+
+    Returns
+    -------
+    list
+        chain of (function, band) applied in the order of dic_bands
+    """
+    if isinstance(dic_bands, list):
+        return dic_bands
+    chain = []
+    for nbands, name_func in (dic_bands or {}).items():
+        if name_func not in BAND_FUNCTIONS:
+            raise ValueError(
+                f"unknown function {name_func}, choose in {list(BAND_FUNCTIONS)}"
+            )
+        chain.append((BAND_FUNCTIONS[name_func], int(nbands)))
+    return chain
+
+
+def apply_band_chain(array, chain):
+    """Apply a compiled chain of band functions in place on the array"""
+    for func, nbands in chain:
+        func(array, nbands, inplace=True)
+    return array
+
+
 def apply_function(file_name, dic_bands):
-    for nbands in dic_bands:
-        name_func = dic_bands[nbands]
-        func = eval(name_func)
-        array, geo = load_data(file_name)
-        remove(file_name)
-        array = func(array, nbands)
-        array2raster(array, geo, file_name)
+    """Apply the band functions to a raster in place, block by block"""
+    chain = compile_band_chain(dic_bands)
+    ds = gdal.Open(file_name, gdal.GA_Update)
+    for window in iter_blocks(ds):
+        array = apply_band_chain(read_block(ds, window), chain)
+        write_block(ds, array, window)
+    ds = None
     return 1
 
 
@@ -239,9 +373,15 @@ def check_projection(inref, inraster):
     return pr_ref == pr_c
 
 
-def check_ResProj_files(aux_path, data_path):
-    re_d, pr_d = check_data(data_path)
-    re_a, pr_a = check_data(aux_path)
+def check_ResProj_files(aux_path, data_path, workers=-1, cache_file=None):
+    """Check that the data and the auxiliary data share their resolution and
+    projection, every incompatible file is reported"""
+    data = check_data(data_path, workers, cache_file)
+    aux = check_data(aux_path, workers, cache_file)
+    if not (data and aux):
+        return 0
+    re_d, pr_d = data
+    re_a, pr_a = aux
     if re_d == re_a and pr_d == pr_a:
         return 1
     else:
@@ -259,19 +399,123 @@ def gdal_resampling(i_path, resolution):
     return o_path
 
 
-def check_data(data_path):
-    data_files = glob.glob(data_path)
-    dataR = data_files[0]
-    for i in data_files[1:]:
-        condR = check_resolution(dataR, i)
-        condP = check_projection(dataR, i)
-        if condR and condP:
-            dataR = i
+def raster_header(file_name):
+    """Header of a raster (the pixels are not read)
+
+    Returns
+    -------
+    dict
+        file, mtime_ns and size (bytes) of the file, geotransform,
+        projection, cols, rows, bands and dtype of the raster
+    """
+    st = stat(file_name)
+    ds = gdal.Open(file_name, gdal.GA_ReadOnly)
+    header = {
+        "file": file_name,
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "geotransform": list(ds.GetGeoTransform()),
+        "projection": ds.GetProjection(),
+        "cols": ds.RasterXSize,
+        "rows": ds.RasterYSize,
+        "bands": ds.RasterCount,
+        "dtype": gdal.GetDataTypeName(ds.GetRasterBand(1).DataType),
+    }
+    ds = None
+    return header
+
+
+def scan_headers(data_path, workers=-1, cache_file=None):
+    """Headers of all the rasters matching a glob pattern, every file is
+    opened once and in parallel (threads, the work is I/O bound)
+
+    Parameters
+    ----------
+    data_path : str
+        glob pattern of the rasters
+    workers : int, optional
+        number of threads, by default -1
+    cache_file : str, optional
+        json file keeping the headers between runs, a header is reused while
+        the mtime and the size of its file are unchanged, by default None
+
+    Returns
+    -------
+    list
+        headers (see raster_header) sorted by file name
+    """
+    files = sorted(glob.glob(data_path))
+    cache = {}
+    if cache_file is not None and exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+    headers, missing = {}, []
+    for i in files:
+        h = cache.get(i)
+        st = stat(i)
+        if h is not None and (h["mtime_ns"], h["size"]) == (
+            st.st_mtime_ns,
+            st.st_size,
+        ):
+            headers[i] = h
         else:
+            missing.append(i)
+    if missing:
+        scanned = Parallel(n_jobs=workers, prefer="threads")(
+            delayed(raster_header)(i) for i in missing
+        )
+        headers.update({h["file"]: h for h in scanned})
+        if cache_file is not None:
+            cache.update(headers)
+            makedirs(dirname(cache_file) or ".", exist_ok=True)
+            tmp = f"{cache_file}.{getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            replace(tmp, cache_file)
+    return [headers[i] for i in files]
+
+
+def incompatible_headers(headers, reference=None):
+    """Mask of the headers whose resolution or projection differ from the
+    reference (by default the first header)"""
+    reference = headers[0] if reference is None else reference
+    res = np.array([h["geotransform"][1] for h in headers])
+    proj = np.array([h["projection"] for h in headers], dtype=object)
+    return (res != reference["geotransform"][1]) | (proj != reference["projection"])
+
+
+def check_data(data_path, workers=-1, cache_file=None):
+    """Check that all the rasters matching a glob pattern share their
+    resolution and projection
+
+    Returns
+    -------
+    tuple or int
+        (resolution, projection) of the rasters, 0 if they are not
+        compatible (all the incompatible files are printed) or if no file
+        matches
+    """
+    headers = scan_headers(data_path, workers, cache_file)
+    if len(headers) == 0:
+        print(f"no data found in {data_path}")
+        return 0
+    bad = incompatible_headers(headers)
+    if bad.any():
+        ref = headers[0]
+        print(
+            f"{bad.sum()} file(s) not compatible with {ref['file']} "
+            f"(resolution {ref['geotransform'][1]})"
+        )
+        for h in np.array(headers)[bad]:
+            condR = h["geotransform"][1] == ref["geotransform"][1]
+            condP = h["projection"] == ref["projection"]
             print(f"data not compatible in projection {condP} or resolution {condR}")
-            print(i)
-            return 0
-    return gdal_resolution(dataR), gdal_projection(dataR)
+            print(h["file"])
+        return 0
+    return headers[0]["geotransform"][1], headers[0]["projection"]
 
 
 def check_with_nan(img):
@@ -296,26 +540,54 @@ def clean_data_nan(path):
             remove(i)
 
 
+def stats_raster(file_name, nodata=-998):
+    """Mean, std, min and max of the valid pixels (> nodata) of every band of
+    a raster, accumulated block by block
+
+    Returns
+    -------
+    dict
+        "mean", "std", "min", "max" lists (one value per band), None if a
+        band has no valid pixel
+    """
+    ds = gdal.Open(file_name, gdal.GA_ReadOnly)
+    nbands = ds.RasterCount
+    count = np.zeros(nbands)
+    total, total2 = np.zeros(nbands), np.zeros(nbands)
+    vmin, vmax = np.full(nbands, np.inf), np.full(nbands, -np.inf)
+    for window in iter_blocks(ds):
+        c = read_block(ds, window)
+        for v in range(nbands):
+            values = c[:, :, v][c[:, :, v] > nodata].astype(np.float64)
+            if len(values) == 0:
+                continue
+            count[v] += len(values)
+            total[v] += values.sum()
+            total2[v] += np.square(values).sum()
+            vmin[v] = min(vmin[v], values.min())
+            vmax[v] = max(vmax[v], values.max())
+    ds = None
+    if np.any(count == 0):
+        return None
+    mean = total / count
+    std = np.sqrt(np.maximum(total2 / count - mean**2, 0))
+    return {
+        "mean": mean.tolist(),
+        "std": std.tolist(),
+        "min": vmin.tolist(),
+        "max": vmax.tolist(),
+    }
+
+
 def stats_dataset(path, dico):
     list_files = glob.glob(join(path, "*.tif"))
     for i in tqdm(list_files):
-        c, _ = load_data(i)
-        nbands = c.shape[2]
-        try:
-            dico["mean"].append(
-                [np.mean(c[:, :, v][c[:, :, v] > -998]) for v in range(nbands)]
-            )
-            dico["std"].append(
-                [np.std(c[:, :, v][c[:, :, v] > -998]) for v in range(nbands)]
-            )
-            dico["min"].append(
-                [np.min(c[:, :, v][c[:, :, v] > -998]) for v in range(nbands)]
-            )
-            dico["max"].append(
-                [np.max(c[:, :, v][c[:, :, v] > -998]) for v in range(nbands)]
-            )
-        except:
+        stats = stats_raster(i)
+        if stats is None:
             print(i)
+            continue
+        for key in ["mean", "std", "min", "max"]:
+            dico[key].append(stats[key])
     return dico
 
 
@@ -330,51 +602,489 @@ def extract_patch_clean(path, output_path, winsize, step):
     clean_data_nan(join(output_path, "*.tif"))
 
 
-def gdal_clip_shp_raster(inraster, inshape, outraster, country_name):
-    subprocess.call(
-        [
-            "gdalwarp",
-            "-of",
-            "Gtiff",
-            "-dstnodata",
-            "value -999",
-            "-ot",
-            "Float32",
-            inraster,
-            outraster,
-            "-cutline",
-            inshape,
-            "-crop_to_cutline",
-            "-cwhere",
-            f"id='{country_name}'",
-        ]
+def raster_grid(inraster):
+    """Grid of a raster: (geotransform, projection, (cols, rows))"""
+    ds = gdal.Open(inraster, gdal.GA_ReadOnly)
+    grid = (
+        tuple(ds.GetGeoTransform()),
+        ds.GetProjection(),
+        (ds.RasterXSize, ds.RasterYSize),
+    )
+    ds = None
+    return grid
+
+
+def clip_raster_massifs(inraster, windows, outputs, nodata=-999):
+    """Clip one raster on several massifs in a single opening, in process
+
+    Equivalent to a gdalwarp -cutline -crop_to_cutline for every massif: the
+    pixels outside the massif and the nodata pixels of the source are set to
+    nodata.
+
+    Parameters
+    ----------
+    inraster : str
+        path to the raster to clip
+    windows : dict
+        name of the massif -> (window, mask) on the grid of the raster,
+        see massif_windows
+    outputs : dict
+        name of the massif -> path of the clipped raster
+    nodata : float, optional
+        nodata value of the clipped rasters, by default -999
+
+    Returns
+    -------
+    int
+        1 if the raster is clipped
+    """
+    ds = gdal.Open(inraster, gdal.GA_ReadOnly)
+    if ds is None:
+        print("Couldn't open this file: %s" % (inraster))
+        return 0
+    geotransform, projection = ds.GetGeoTransform(), ds.GetProjection()
+    src_nodata = [
+        ds.GetRasterBand(i + 1).GetNoDataValue() for i in range(ds.RasterCount)
+    ]
+    for name, (window, inside) in windows.items():
+        array = read_block(ds, window)
+        for i, value in enumerate(src_nodata):
+            if value is not None:
+                array[:, :, i][array[:, :, i] == value] = nodata
+        array[~inside] = nodata
+        gt = window_geotransform(geotransform, window)
+        array2raster(array, (gt, projection), outputs[name], nodata=nodata)
+    ds = None
+    return 1
+
+
+def stack_grid(datasets):
+    """Grid covering the union of datasets with the same resolution
+
+    Parameters
+    ----------
+    datasets : list
+        opened gdal.Dataset, the first one gives the resolution
+
+    Returns
+    -------
+    tuple
+        geotransform
+    int
+        xsize
+    int
+        ysize
+    """
+    gt = datasets[0].GetGeoTransform()
+    x0, y0, x1, y1 = [], [], [], []
+    for ds in datasets:
+        gt_ds = ds.GetGeoTransform()
+        xoff = int(round((gt_ds[0] - gt[0]) / gt[1]))
+        yoff = int(round((gt_ds[3] - gt[3]) / gt[5]))
+        x0.append(xoff)
+        y0.append(yoff)
+        x1.append(xoff + ds.RasterXSize)
+        y1.append(yoff + ds.RasterYSize)
+    window = (min(x0), min(y0))
+    return window_geotransform(gt, window), max(x1) - min(x0), max(y1) - min(y0)
+
+
+def build_stack_vrt(sources, vrt_path, nodata=-999):
+    """Virtual raster stacking all the bands of rasters with the same
+    resolution (unlike gdal.BuildVRT(separate=True) which only keeps the
+    first band of each source), nothing is copied
+
+    Parameters
+    ----------
+    sources : list
+        paths of the rasters, stacked in this order
+    vrt_path : str
+        path of the .vrt to write
+    nodata : float, optional
+        value outside the sources, by default -999
+
+    Returns
+    -------
+    str
+        vrt_path
+    """
+    datasets = [gdal.Open(i) for i in sources]
+    gt, xsize, ysize = stack_grid(datasets)
+    root = dirname(vrt_path)
+    bands = []
+    for src, ds in zip(sources, datasets):
+        gt_ds = ds.GetGeoTransform()
+        xoff = int(round((gt_ds[0] - gt[0]) / gt[1]))
+        yoff = int(round((gt_ds[3] - gt[3]) / gt[5]))
+        if dirname(src) == root:
+            name, relative = basename(src), 1
+        else:
+            name, relative = src, 0
+        for i in range(ds.RasterCount):
+            bands.append(
+                f'  <VRTRasterBand dataType="Float32" band="{len(bands) + 1}">\n'
+                f"    <NoDataValue>{nodata}</NoDataValue>\n"
+                f"    <SimpleSource>\n"
+                f'      <SourceFilename relativeToVRT="{relative}">'
+                f"{escape(name)}</SourceFilename>\n"
+                f"      <SourceBand>{i + 1}</SourceBand>\n"
+                f'      <SrcRect xOff="0" yOff="0" xSize="{ds.RasterXSize}" '
+                f'ySize="{ds.RasterYSize}" />\n'
+                f'      <DstRect xOff="{xoff}" yOff="{yoff}" '
+                f'xSize="{ds.RasterXSize}" ySize="{ds.RasterYSize}" />\n'
+                f"    </SimpleSource>\n"
+                f"  </VRTRasterBand>\n"
+            )
+    projection = datasets[0].GetProjection()
+    datasets = None
+    with open(vrt_path, "w") as f:
+        f.write(f'<VRTDataset rasterXSize="{xsize}" rasterYSize="{ysize}">\n')
+        f.write(f"  <SRS>{escape(projection)}</SRS>\n")
+        f.write(f"  <GeoTransform>{', '.join(repr(v) for v in gt)}</GeoTransform>\n")
+        f.writelines(bands)
+        f.write("</VRTDataset>\n")
+    return vrt_path
+
+
+def stack_rasters(sources, outraster, nodata=-999, gdal_driver="GTiff"):
+    """Stack all the bands of rasters with the same resolution in one raster,
+    written once block by block (same result as chaining gdal_merge.py
+    -separate -n 0: union of the extents, pixels at 0 or outside the sources
+    set to nodata)
+
+    Parameters
+    ----------
+    sources : list
+        paths of the rasters (or virtual rasters), stacked in this order
+    outraster : str
+        path of the output raster
+    nodata : float, optional
+        nodata value of the output, by default -999
+    gdal_driver : str, optional
+        gdal driver of the output, by default "GTiff"
+
+    Returns
+    -------
+    str
+        outraster
+    """
+    datasets = [gdal.Open(i) for i in sources]
+    gt, xsize, ysize = stack_grid(datasets)
+    bands = sum(ds.RasterCount for ds in datasets)
+    driver = gdal.GetDriverByName(gdal_driver)
+    outDs = driver.Create(
+        outraster,
+        xsize,
+        ysize,
+        bands,
+        gdal.GDT_Float32,
+        options=["COMPRESS=NONE", "BIGTIFF=IF_NEEDED"],
+    )
+    outDs.SetGeoTransform(gt)
+    outDs.SetProjection(datasets[0].GetProjection())
+    for i in range(bands):
+        outDs.GetRasterBand(i + 1).SetNoDataValue(nodata)
+    for window in iter_blocks(outDs):
+        gt_window = window_geotransform(gt, window)
+        array = np.concatenate(
+            [
+                read_aligned_window(ds, gt_window, window[2], window[3], fill=nodata)
+                for ds in datasets
+            ],
+            axis=2,
+        )
+        array[array == 0] = nodata
+        write_block(outDs, array, window)
+    outDs.FlushCache()
+    outDs = None
+    datasets = None
+    return outraster
+
+
+def pixel_window(geotransform, size, envelope):
+    """Pixel window of an envelope in a north-up grid, clipped to the raster
+
+    Parameters
+    ----------
+    geotransform : tuple
+        geotransform of the grid
+    size : tuple
+        (cols, rows) of the grid
+    envelope : tuple
+        (minx, maxx, miny, maxy) in the projection of the grid
+
+    Returns
+    -------
+    tuple
+        (xoff, yoff, xsize, ysize) or None if the envelope is outside the grid
+    """
+    minx, maxx, miny, maxy = envelope
+    x0 = int(np.floor((minx - geotransform[0]) / geotransform[1]))
+    x1 = int(np.ceil((maxx - geotransform[0]) / geotransform[1]))
+    y0 = int(np.floor((maxy - geotransform[3]) / geotransform[5]))
+    y1 = int(np.ceil((miny - geotransform[3]) / geotransform[5]))
+    x0, x1 = max(x0, 0), min(x1, size[0])
+    y0, y1 = max(y0, 0), min(y1, size[1])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def window_geotransform(geotransform, window):
+    """Geotransform of a pixel window (xoff, yoff, xsize, ysize) of a grid"""
+    xoff, yoff = window[:2]
+    return (
+        geotransform[0] + xoff * geotransform[1],
+        geotransform[1],
+        0.0,
+        geotransform[3] + yoff * geotransform[5],
+        0.0,
+        geotransform[5],
     )
 
 
-def gdal_merge_rasters(in_R1, in_R2, outraster):
-    gdal_merge.main(
-        [
-            "",
-            "-o",
-            outraster,
-            "-separate",
-            "-ot",
-            "Float32",
-            "-of",
-            "GTiff",
-            "-n",
-            "0",
-            "-a_nodata",
-            "-999",
-            "-ot",
-            "Float32",
-            "-of",
-            "GTiff",
-            "-co",
-            "COMPRESS=NONE",
-            "-co",
-            "BIGTIFF=IF_NEEDED",
-            in_R1,
-            in_R2,
-        ]
+def rasterize_geometry(geom, geotransform, xsize, ysize, projection):
+    """Inclusion mask of a geometry on a grid (pixel centers inside)"""
+    mem_ds = gdal.GetDriverByName("MEM").Create("", xsize, ysize, 1, gdal.GDT_Byte)
+    mem_ds.SetGeoTransform(geotransform)
+    mem_ds.SetProjection(projection)
+    srs = osr.SpatialReference(wkt=projection)
+    ogr_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+    lyr = ogr_ds.CreateLayer("massif", srs=srs)
+    ft = ogr.Feature(lyr.GetLayerDefn())
+    ft.SetGeometry(geom)
+    lyr.CreateFeature(ft)
+    gdal.RasterizeLayer(mem_ds, [1], lyr, burn_values=[1])
+    return mem_ds.GetRasterBand(1).ReadAsArray().astype(bool)
+
+
+def massif_windows(shp_file, geotransform, projection, size, field="id"):
+    """Pixel window and inclusion mask of every massif of a shapefile on a grid
+
+    Parameters
+    ----------
+    shp_file : str
+        path to the shapefile of the massifs
+    geotransform : tuple
+        geotransform of the grid
+    projection : str
+        projection (WKT) of the grid
+    size : tuple
+        (cols, rows) of the grid
+    field : str, optional
+        field of the name of the massif, by default "id"
+
+    Returns
+    -------
+    dict
+        name of the massif -> (window (xoff, yoff, xsize, ysize), mask (bool))
+    """
+    ds = ogr.Open(shp_file)
+    lyr = ds.GetLayer(0)
+    dst_srs = osr.SpatialReference(wkt=projection)
+    src_srs = lyr.GetSpatialRef()
+    transform = None
+    if src_srs is not None and not src_srs.IsSame(dst_srs):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(src_srs, dst_srs)
+    windows = {}
+    lyr.ResetReading()
+    for ft in lyr:
+        geom = ft.GetGeometryRef().Clone()
+        if transform is not None:
+            geom.Transform(transform)
+        window = pixel_window(geotransform, size, geom.GetEnvelope())
+        if window is None:
+            continue
+        gt = window_geotransform(geotransform, window)
+        mask = rasterize_geometry(geom, gt, window[2], window[3], projection)
+        windows[ft.GetFieldAsString(field)] = (window, mask)
+    ds = None
+    return windows
+
+
+def file_hash(path, block_size=2**20):
+    """sha1 of the content of a file"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def shapefile_hash(shp_file):
+    """sha1 of the content of a shapefile and of its companion files"""
+    h = hashlib.sha1()
+    for ext in [".shp", ".shx", ".dbf", ".prj", ".cpg"]:
+        path = splitext(shp_file)[0] + ext
+        if exists(path):
+            h.update(file_hash(path).encode())
+    return h.hexdigest()
+
+
+def cached_massif_windows(
+    shp_file, geotransform, projection, size, cache_dir, field="id"
+):
+    """massif_windows stored in a persistent cache
+
+    The windows and the bit-packed masks are stored in cache_dir, in a .npz
+    file keyed by the content of the shapefile and by the grid, so that a
+    modified shapefile or a new grid gives a new entry.
+
+    Parameters
+    ----------
+    shp_file : str
+        path to the shapefile of the massifs
+    geotransform : tuple
+        geotransform of the grid
+    projection : str
+        projection (WKT) of the grid
+    size : tuple
+        (cols, rows) of the grid
+    cache_dir : str
+        directory of the cache
+    field : str, optional
+        field of the name of the massif, by default "id"
+
+    Returns
+    -------
+    dict
+        name of the massif -> (window (xoff, yoff, xsize, ysize), mask (bool))
+    """
+    key = hashlib.sha1(
+        repr(
+            (
+                shapefile_hash(shp_file),
+                tuple(geotransform),
+                projection,
+                tuple(size),
+                field,
+            )
+        ).encode()
+    ).hexdigest()
+    path = join(cache_dir, f"windows_{key}.npz")
+    if exists(path):
+        with np.load(path) as cache:
+            windows = {}
+            for k, name in enumerate(cache["names"]):
+                window = tuple(int(v) for v in cache["windows"][k])
+                mask = np.unpackbits(cache[f"mask_{k}"], count=window[2] * window[3])
+                windows[str(name)] = (window, mask.reshape(window[3], window[2]) == 1)
+            return windows
+    windows = massif_windows(shp_file, geotransform, projection, size, field)
+    names = list(windows.keys())
+    masks = {
+        f"mask_{k}": np.packbits(windows[name][1].ravel())
+        for k, name in enumerate(names)
+    }
+    makedirs(cache_dir, exist_ok=True)
+    tmp = join(cache_dir, f"windows_{key}.{getpid()}.tmp.npz")
+    np.savez(
+        tmp,
+        names=np.array(names, dtype=str),
+        windows=np.array([windows[name][0] for name in names], dtype=np.int64).reshape(
+            -1, 4
+        ),
+        **masks,
     )
+    replace(tmp, path)
+    return windows
+
+
+def read_aligned_window(ds, geotransform, xsize, ysize, fill=-999):
+    """Read the pixels of a dataset covering a window of another grid with the
+    same resolution, the pixels outside the dataset are filled
+
+    Parameters
+    ----------
+    ds : gdal.Dataset
+        opened dataset
+    geotransform : tuple
+        geotransform of the window
+    xsize, ysize : int
+        size of the window
+    fill : float, optional
+        value outside the dataset, by default -999
+
+    Returns
+    -------
+    np.array
+        window (ysize, xsize, bands) in float32
+    """
+    gt = ds.GetGeoTransform()
+    x0 = int(round((geotransform[0] - gt[0]) / gt[1]))
+    y0 = int(round((geotransform[3] - gt[3]) / gt[5]))
+    array = np.full((ysize, xsize, ds.RasterCount), fill, dtype=np.float32)
+    xa, ya = max(x0, 0), max(y0, 0)
+    xb, yb = min(x0 + xsize, ds.RasterXSize), min(y0 + ysize, ds.RasterYSize)
+    if xb <= xa or yb <= ya:
+        return array
+    for i in range(ds.RasterCount):
+        array[ya - y0 : yb - y0, xa - x0 : xb - x0, i] = ds.GetRasterBand(
+            i + 1
+        ).ReadAsArray(xa, ya, xb - xa, yb - ya)
+    return array
+
+
+def fused_scene_pass(
+    scene, windows, outputs, mask_path=None, aux_files=None, dic_bands=None
+):
+    """Preprocess one scene in a single pass: for every massif window, read
+    the scene once, mask the layover, stack the auxiliary bands, apply the
+    band transformations and write the final clipped raster
+
+    The result matches mask_layover, clip_raster_massifs, stack_rasters and
+    apply_function chained: pixels outside the massif, in the layover or
+    equal to 0 (nodata of the stacking) are set to -999, the nodata value of
+    the output rasters.
+
+    Parameters
+    ----------
+    scene : str
+        path to the scene
+    windows : dict
+        name of the massif -> (window, mask), see massif_windows
+    outputs : dict
+        name of the massif -> path of the output raster
+    mask_path : str, optional
+        path to the layover mask (1 for the layover), by default None
+    aux_files : list, optional
+        paths of the auxiliary rasters stacked after the scene, by default
+        None (no auxiliary raster)
+    dic_bands : dict or list, optional
+        band -> name of the function to apply, or compiled chain (see
+        compile_band_chain), by default None
+
+    Returns
+    -------
+    int
+        1 if the scene is processed
+    """
+    ds = gdal.Open(scene, gdal.GA_ReadOnly)
+    if ds is None:
+        print("Couldn't open this file: %s" % (scene))
+        return 0
+    geotransform, projection = ds.GetGeoTransform(), ds.GetProjection()
+    mask_ds = gdal.Open(mask_path, gdal.GA_ReadOnly) if mask_path else None
+    aux_ds = [gdal.Open(a, gdal.GA_ReadOnly) for a in aux_files or []]
+    chain = compile_band_chain(dic_bands)
+    for name, (window, inside) in windows.items():
+        gt = window_geotransform(geotransform, window)
+        xsize, ysize = window[2], window[3]
+        array = read_aligned_window(ds, gt, xsize, ysize)
+        array[array == 0] = -999
+        if mask_ds is not None:
+            layover = read_aligned_window(mask_ds, gt, xsize, ysize, fill=0)
+            array[layover[:, :, 0] == 1] = -999
+        stack = [array]
+        for a in aux_ds:
+            aux = read_aligned_window(a, gt, xsize, ysize)
+            aux[aux == 0] = -999
+            stack.append(aux)
+        array = np.concatenate(stack, axis=2)
+        array[~inside] = -999
+        apply_band_chain(array, chain)
+        array2raster(array, (gt, projection), outputs[name], nodata=-999)
+    ds = mask_ds = aux_ds = None
+    return 1
@@ -1,19 +1,76 @@
 import numpy as np
-from numba import jit
 
 
-@jit(nopython=True)
-def SAR_patch_clean(x, windows_size, step, start=0):
+def valid_window_origins(x, windows_size, step, start=0):
+    """Origins of the windows of the grid (start::step on the rows and the
+    columns) inside the image, without -999 values and with positive values
+    on the two first channels
+
+    The invalid pixels are counted in each window with a summed-area table,
+    the origins are returned in row major order.
+
+    Parameters
+    ----------
+    x : np.array
+        image (rows, cols, channels)
+    windows_size : int
+        size of the windows
+    step : int
+        step between two windows
+    start : int, optional
+        first row and column of the grid, by default 0
+
+    Returns
+    -------
+    np.array
+        rows of the origins
+    np.array
+        columns of the origins
+    """
     xsize, ysize, _ = x.shape
-    f = [
-        x[i : i + windows_size, j : j + windows_size, :]
-        for i in range(start, xsize, step)
-        for j in range(start, ysize, step)
-        if (
-            x[i : i + windows_size, j : j + windows_size, :].shape[:2]
-            == (windows_size, windows_size)
-        )
-        & (np.all(x[i : i + windows_size, j : j + windows_size, :] != -999))
-        & (np.all(x[i : i + windows_size, j : j + windows_size, :2] > 0))
-    ]
-    return f
+    invalid = np.any(x == -999, axis=2) | np.any(~(x[:, :, :2] > 0), axis=2)
+    sat = np.zeros((xsize + 1, ysize + 1), dtype=np.int64)
+    sat[1:, 1:] = invalid.cumsum(axis=0).cumsum(axis=1)
+    rows = np.arange(start, xsize - windows_size + 1, step)
+    cols = np.arange(start, ysize - windows_size + 1, step)
+    r0, c0 = rows[:, None], cols[None, :]
+    r1, c1 = r0 + windows_size, c0 + windows_size
+    count = sat[r1, c1] - sat[r0, c1] - sat[r1, c0] + sat[r0, c0]
+    ii, jj = np.nonzero(count == 0)
+    return rows[ii], cols[jj]
+
+
+def SAR_patch_extract(x, windows_size, step, start=0, block=4096):
+    """Extract the valid patches of the grid (see valid_window_origins), in
+    row major order, in a single preallocated array
+
+    Parameters
+    ----------
+    x : np.array
+        image (rows, cols, channels)
+    windows_size : int
+        size of the windows
+    step : int
+        step between two windows
+    start : int, optional
+        first row and column of the grid, by default 0
+    block : int, optional
+        number of patches gathered at once, by default 4096
+
+    Returns
+    -------
+    np.array
+        patches (n, windows_size, windows_size, channels) in float32
+        :info: without valid patch the shape is still 4-d,
+        (0, windows_size, windows_size, channels) and not (0,)
+    """
+    rows, cols = valid_window_origins(x, windows_size, step, start)
+    offset = np.arange(windows_size)
+    patchs = np.empty(
+        (len(rows), windows_size, windows_size, x.shape[2]), dtype=np.float32
+    )
+    for k in range(0, len(rows), block):
+        r = rows[k : k + block, None, None] + offset[None, :, None]
+        c = cols[k : k + block, None, None] + offset[None, None, :]
+        patchs[k : k + block] = x[r, c]
+    return patchs
@@ -1,154 +1,282 @@
-from os.path import basename
+from os.path import basename, exists
+from os import stat
 import pandas as pd
 import numpy as np
+import pickle
+import json
 
+ALTITUDE_CLASSES = np.arange(0, 5100, 300)
+SLOPE_CLASSES = np.array([0, 20, 45])
+ORIENTATION_CLASSES = np.arange(0, 360, 45)
 
-def prepare_label(label_array, type_d):
-    dic = {}
-    mtd, tpg, phy = [], [], []
-    for i in range(len(label_array)):
-        phy.append(label_array[i][:3])
-        tpg.append(label_array[i][3:6])
-        mtd_temp = label_array[i][6:]
-        mtd_temp.append(type_d)
-        mtd.append(mtd_temp)
-    dic["metadata"] = np.array(mtd, dtype=np.string_)
-    dic["topography"] = np.array(tpg, dtype=np.float32)
-    dic["physics"] = np.array(phy, dtype=np.float32)
-    return dic
 
-
-def process_file_II(array_R, i, tel):
-    hpo = extract_topo(array_R)
-    label_R = expert_label_snow(i, tel, hpo)
-    return array_R, label_R
-
-
-def mean_angle(deg):
+def mean_angle_batch(deg):
+    """Circular mean (degrees in [0, 360)) of the angles of a batch of
+    patches (n, rows, cols)"""
     deg = np.deg2rad(deg)
-    x = np.mean(np.cos(deg))
-    y = np.mean(np.sin(deg))
+    x = np.mean(np.cos(deg), axis=(1, 2))
+    y = np.mean(np.sin(deg), axis=(1, 2))
     res = np.rad2deg(np.arctan2(y, x)).round(3)
-    if res < 0:
-        return max(res, 360 + res)
-    else:
-        return res
+    return np.where(res < 0, 360 + res, res)
 
 
-def altitude_plage(plg):
+def altitude_plage_batch(plg):
+    """Nearest elevation classes (every 300 m) of an array of elevations"""
     h = np.arange(0, 5100, 300)
-    altitude = h[np.argmin(np.abs(h - plg))]
-    return altitude
+    return h[np.argmin(np.abs(h[None, :] - np.asarray(plg)[:, None]), axis=1)]
 
 
-def theta_plage(theta):
+def theta_plage_batch(theta):
+    """Orientation classes (sectors of 45 degrees) of an array of orientations"""
     t0 = np.arange(22.5, 360 + 22.5, 45)
     t = np.arange(0, 360, 45)
-    if theta > t0[-1] or theta < t0[0]:
-        ct = t[0]
-    else:
-        ind = np.where(theta < t0)[0][0]
-        ct = t[ind]
-    return ct
+    theta = np.asarray(theta)
+    ind = np.searchsorted(t0, theta, side="right")
+    out = (theta > t0[-1]) | (theta < t0[0]) | (ind >= len(t))
+    return np.where(out, t[0], t[np.minimum(ind, len(t) - 1)])
 
 
-def pente_plage(p):
-    if (p < 2) & (p >= 0):
-        pente = 0
-    elif (p < 30) & (p >= 2):
-        pente = 20
-    else:
-        pente = 45
-    return pente
-
-
-def stations2crocus(o):
-    high = o.altitude.values[0]
-    theta = o.orientation.values[0]
-    pente = o.pente.values[0]
-    hpo = altitude_plage(high), pente_plage(pente), theta_plage(theta)
-    return hpo
-
-
-def extract_topo(img):
-    info = pd.DataFrame()
-    info["altitude"] = [img[:, :, 3].mean()]
-    info["altitude_std"] = [img[:, :, 3].std()]
-    info["orientation"] = [mean_angle(img[:, :, 4])]
-    info["pente"] = [img[:, :, 5].mean()]
-    return stations2crocus(info)
-
-
-def expert_label_snow(i, tel, hpo):
-    name_base = basename(i)[:-4]
-    massif = name_base.split("_")[0]
-    date_sample = name_base.split("_")[1]
-    if (hpo in list(tel[0][massif].keys())) and (hpo in list(tel[1][massif].keys())):
-        try:
-            dframe_sample = (
-                tel[0][massif][hpo].loc[date_sample],
-                tel[1][massif][hpo].loc[date_sample],
-                tel[2][massif][hpo].loc[date_sample],
-            )
-        except:
-            return -1
-    else:
-        return -1
-    cond_ex = (
-        (len(dframe_sample[0]) > 0)
-        and (len(dframe_sample[1]) > 0)
-        and len(dframe_sample[2]) > 0
+def pente_plage_batch(p):
+    """Slope classes (0, 20 or 45) of an array of slopes"""
+    p = np.asarray(p)
+    return np.where((p < 2) & (p >= 0), 0, np.where((p < 30) & (p >= 2), 20, 45))
+
+
+def extract_topo_batch(imgs):
+    """Elevation, slope and orientation classes of a batch of patches, from
+    the mean elevation, slope and orientation (channels 3, 5 and 4)
+
+    Parameters
+    ----------
+    imgs : np.array
+        patches (n, rows, cols, channels)
+
+    Returns
+    -------
+    np.array
+        classes (n, 3): elevation, slope and orientation
+    """
+    altitude = imgs[:, :, :, 3].mean(axis=(1, 2))
+    orientation = mean_angle_batch(imgs[:, :, :, 4])
+    pente = imgs[:, :, :, 5].mean(axis=(1, 2))
+    return np.stack(
+        [
+            altitude_plage_batch(altitude),
+            pente_plage_batch(pente),
+            theta_plage_batch(orientation),
+        ],
+        axis=1,
     )
-    cond_nan = (
-        (dframe_sample[0].isnull().values.any())
-        or (dframe_sample[1].isnull().values.any())
-        or (dframe_sample[2].isnull().values.any())
+
+
+def date_index_to_str(index):
+    """Dates of an index of a Crocus simulation as YYYYMMDD strings"""
+    if isinstance(index, pd.DatetimeIndex):
+        return np.array(index.strftime("%Y%m%d"), dtype=str)
+    index = np.array(index.astype(str), dtype=str)
+    if np.all(np.char.str_len(index) == 8) and np.all(np.char.isdigit(index)):
+        return index
+    return np.array(pd.to_datetime(index).strftime("%Y%m%d"), dtype=str)
+
+
+def class_index(value, classes):
+    """Index of a class value in the array of classes, -1 if not a class"""
+    ind = np.searchsorted(classes, value)
+    ind = np.minimum(ind, len(classes) - 1)
+    return np.where(classes[ind] == value, ind, -1)
+
+
+def compile_crocus_table(tel):
+    """Compile the Crocus simulations in one dense table
+
+    The table is indexed by [massif, date, elevation class, slope class,
+    orientation class] and holds (tmin, hs, tel), NaN for the combinations
+    without simulation or with a missing value.
+
+    Parameters
+    ----------
+    tel : list
+        Crocus simulations (tmin, hs, tel), dictionaries massif -> class
+        (elevation, slope, orientation) -> pd.DataFrame indexed by date
+
+    Returns
+    -------
+    dict
+        "values": table (massif, date, 17, 3, 8, 3) in float32,
+        "massif": list of the massifs, "date": list of the dates (YYYYMMDD)
+    """
+    columns = ["tmin", "hs", "tel"]
+    frames = {}
+    for massif in tel[0]:
+        for hpo in tel[0][massif]:
+            if all(hpo in tel[k].get(massif, {}) for k in range(1, 3)):
+                frames[(massif, hpo)] = [tel[k][massif][hpo] for k in range(3)]
+    massifs = sorted({m for m, _ in frames})
+    dates = sorted(
+        {d for fr in frames.values() for f in fr for d in date_index_to_str(f.index)}
     )
-    if cond_ex and not cond_nan:
-        return [
-            dframe_sample[0].tmin,
-            dframe_sample[1].hs,
-            dframe_sample[2].tel,
-            hpo[0],
-            hpo[1],
-            hpo[2],
-            date_sample,
-            massif,
-        ]
-    else:
-        return -1
-
-
-def add_labels_II(data, name_file, tel, type_d):
-    results = [
-        process_file_II(raster_a, name_file, tel)
-        for raster_a in data
-        if process_file_II(raster_a, name_file, tel)[1] != -1
-    ]
-    if len(results) > 1:
-        X = np.array([i[0] for i in results], dtype=np.float32)
-        y = [i[1] for i in results]
-        y = prepare_label(y, type_d)  # results[1])
+    values = np.full(
+        (
+            len(massifs),
+            len(dates),
+            len(ALTITUDE_CLASSES),
+            len(SLOPE_CLASSES),
+            len(ORIENTATION_CLASSES),
+            3,
+        ),
+        np.nan,
+        dtype=np.float32,
+    )
+    m_index = {m: i for i, m in enumerate(massifs)}
+    dates = np.array(dates, dtype=str)
+    for (massif, hpo), fr in frames.items():
+        a, p, t = (
+            int(class_index(hpo[0], ALTITUDE_CLASSES)),
+            int(class_index(hpo[1], SLOPE_CLASSES)),
+            int(class_index(hpo[2], ORIENTATION_CLASSES)),
+        )
+        if min(a, p, t) < 0:
+            continue
+        series = []
+        for k, f in enumerate(fr):
+            f = f.set_axis(date_index_to_str(f.index), axis=0)
+            f = f[~f.index.duplicated(keep="first")]
+            series.append(f[columns[k]].where(f.notnull().all(axis=1)))
+        label = pd.concat(series, axis=1, join="inner").dropna()
+        d = np.searchsorted(dates, np.array(label.index, dtype=str))
+        values[m_index[massif], d, a, p, t] = label.values
+    return {"values": values, "massif": massifs, "date": dates.tolist()}
+
+
+def crocus_table_key(csv_GT):
+    """Identity (path, mtime and size) of the Crocus pickles"""
+    return [[p, stat(p).st_mtime_ns, stat(p).st_size] for p in csv_GT]
+
+
+def save_crocus_table(table, path, key=None):
+    """Save a compiled Crocus table as path.npy (memory-mappable) and
+    path.json (massifs, dates and key of the sources)"""
+    np.save(path + ".npy", table["values"])
+    with open(path + ".json", "w") as f:
+        json.dump({"massif": table["massif"], "date": table["date"], "key": key}, f)
+
+
+def load_crocus_table(path):
+    """Load a compiled Crocus table, the values are memory-mapped
+
+    Returns
+    -------
+    dict
+        "values", "massif" and "date" of the table, "key" of the sources
+    """
+    with open(path + ".json", "r") as f:
+        table = json.load(f)
+    table["values"] = np.load(path + ".npy", mmap_mode="r")
+    return table
+
+
+def prepare_crocus_table(csv_GT, path):
+    """Compile the Crocus pickles in a table stored at path, only if the
+    table does not exist or if the pickles changed
+
+    Parameters
+    ----------
+    csv_GT : list
+        paths of the pickles of the Crocus simulations (tmin, hs, tel)
+    path : str
+        path of the table (without extension)
+
+    Returns
+    -------
+    str
+        path of the table
+    """
+    key = crocus_table_key(csv_GT)
+    if exists(path + ".json") and exists(path + ".npy"):
+        if load_crocus_table(path)["key"] == key:
+            return path
+    tel = []
+    for p in csv_GT:
+        with open(p, "rb") as f:
+            tel.append(pickle.load(f))
+    save_crocus_table(compile_crocus_table(tel), path, key)
+    return path
+
+
+def crocus_lookup(table, massif, date_sample, hpo):
+    """Labels (tmin, hs, tel) of the classes of some patches for one massif
+    and one date, NaN when there is no simulation
+
+    Parameters
+    ----------
+    table : dict
+        compiled Crocus table (see load_crocus_table)
+    massif : str
+        name of the massif
+    date_sample : str
+        date (YYYYMMDD)
+    hpo : np.array
+        classes (n, 3): elevation, slope and orientation
+
+    Returns
+    -------
+    np.array
+        labels (n, 3) in float32
+    """
+    labels = np.full((len(hpo), 3), np.nan, dtype=np.float32)
+    dates = table["date"]
+    d = np.searchsorted(dates, date_sample)
+    if (massif not in table["massif"]) or d >= len(dates) or dates[d] != date_sample:
+        return labels
+    m = table["massif"].index(massif)
+    a = class_index(hpo[:, 0], ALTITUDE_CLASSES)
+    p = class_index(hpo[:, 1], SLOPE_CLASSES)
+    t = class_index(hpo[:, 2], ORIENTATION_CLASSES)
+    ok = (a >= 0) & (p >= 0) & (t >= 0)
+    labels[ok] = table["values"][m, d][a[ok], p[ok], t[ok]]
+    return labels
+
+
+def add_labels_II(data, name_file, table, type_d):
+    """Label the patches of one image with the Crocus simulations
+
+    The topographic classes of all the patches are computed at once, the
+    labels are then read in the compiled Crocus table.
+
+    Parameters
+    ----------
+    data : np.array
+        patches of the image (n, rows, cols, channels)
+    name_file : str
+        path of the image, named massif_date.tif
+    table : dict
+        compiled Crocus table (see load_crocus_table)
+    type_d : str
+        type of acquisition (ASC or DSC)
+
+    Returns
+    -------
+    np.array
+        labelled patches in float32
+    dict
+        metadata, topography and physics of the labelled patches
+    """
+    if len(data) == 0:
+        return np.array([]), np.array([])
+    name_base = basename(name_file)[:-4]
+    massif, date_sample = name_base.split("_")[:2]
+    hpo = extract_topo_batch(data)
+    physics = crocus_lookup(table, massif, date_sample, hpo)
+    keep = ~np.isnan(physics).any(axis=1)
+    if keep.sum() > 1:
+        X = np.asarray(data[keep], dtype=np.float32)
+        y = {
+            "metadata": np.array(
+                [[date_sample, massif, type_d]] * len(X), dtype=np.string_
+            ),
+            "topography": hpo[keep].astype(np.float32),
+            "physics": physics[keep],
+        }
     else:
         X, y = np.array([]), np.array([])
     return X, y
-
-
-def select_non_empty_list(extr):
-    x, y = list(zip(*extr))
-    X = []
-    Y = {}
-
-    for i in x:
-        if len(i) > 0:
-            X.extend(i)
-    X = np.array(X, dtype=np.float32)
-
-    for i in y:
-        if len(i) > 0:
-            for k, v in i.items():
-                if k in Y.keys():
-                    Y[k] = np.concatenate((Y[k], v), axis=0)
-                else:
-                    Y[k] = v
-    return X, Y
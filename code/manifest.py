@@ -0,0 +1,109 @@
+from joblib import Parallel, delayed
+from os import stat, makedirs, replace, getpid
+from os.path import exists, dirname
+import hashlib
+import json
+
+from geo_tools import file_hash
+
+MANIFEST_VERSION = 1
+
+
+def params_hash(params):
+    """sha1 of parameters serialisable in json (the order of the keys does
+    not matter)"""
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+class Manifest:
+    """Record of the outputs of a stage of the pipeline, with the key (content
+    of the input files and parameters) they were produced from, so that only
+    the new or modified inputs are processed again
+
+    The content hashes are kept with the mtime and the size of the files and
+    are only recomputed when one of them changed.
+
+    Parameters
+    ----------
+    path : str
+        json file of the manifest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hashes = {}
+        self.info = {}
+        if exists(path):
+            try:
+                with open(path, "r") as f:
+                    content = json.load(f)
+            except ValueError:
+                content = {}
+            if content.get("version") == MANIFEST_VERSION:
+                self.entries = content["entries"]
+                self.hashes = content["hashes"]
+                self.info = content["info"]
+
+    def _stale_hashes(self, paths):
+        stale = []
+        for p in set(paths):
+            st = stat(p)
+            h = self.hashes.get(p)
+            if h is None or h[:2] != [st.st_mtime_ns, st.st_size]:
+                stale.append(p)
+        return stale
+
+    def update_hashes(self, paths, workers=-1):
+        """Compute in parallel the content hashes of the files that are new or
+        modified since they were last hashed"""
+        stale = self._stale_hashes(paths)
+        hashes = Parallel(n_jobs=workers, prefer="threads")(
+            delayed(file_hash)(p) for p in stale
+        )
+        for p, h in zip(stale, hashes):
+            st = stat(p)
+            self.hashes[p] = [st.st_mtime_ns, st.st_size, h]
+
+    def signature(self, path):
+        """Content hash of a file"""
+        if self._stale_hashes([path]):
+            self.update_hashes([path], workers=1)
+        return self.hashes[path][2]
+
+    def key(self, inputs, params=None):
+        """Key of an output produced from input files and parameters"""
+        h = hashlib.sha1()
+        for p in inputs:
+            h.update(self.signature(p).encode())
+        h.update(params_hash(params).encode())
+        return h.hexdigest()
+
+    def is_current(self, name, key):
+        """True if the output name was produced with this key and all its
+        files still exist"""
+        entry = self.entries.get(name)
+        if entry is None or entry["key"] != key:
+            return False
+        return all(exists(o) for o in entry["outputs"])
+
+    def record(self, name, key, outputs, **info):
+        """Record the output files of name produced with key"""
+        self.entries[name] = dict(key=key, outputs=list(outputs), **info)
+
+    def save(self):
+        """Write the manifest (atomic replacement of the json file)"""
+        makedirs(dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "version": MANIFEST_VERSION,
+                    "entries": self.entries,
+                    "hashes": self.hashes,
+                    "info": self.info,
+                },
+                f,
+            )
+        replace(tmp, self.path)
@@ -0,0 +1,233 @@
+from functools import reduce
+import tokenize
+import ast
+import io
+import numpy as np
+import pandas as pd
+
+NS_PER_DAY = 86400 * 10**9
+DATE_FIELDS = ["year", "month", "day", "dayofyear", "dayofweek"]
+COMPARISONS = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.In: "in",
+    ast.NotIn: "not in",
+}
+FLIPPED = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "==", "!=": "!="}
+
+
+def normalise_condition(condition):
+    """Rewrite a pandas query condition in python syntax: one line, and &, |
+    and ~ replaced by and, or and not (pandas gives them the precedence of
+    the boolean operators)"""
+    condition = " ".join(condition.split())
+    replace = {"&": "and", "|": "or", "~": "not"}
+    tokens = []
+    for tok in tokenize.generate_tokens(io.StringIO(condition).readline):
+        if tok.type == tokenize.OP and tok.string in replace:
+            tokens.append((tokenize.NAME, replace[tok.string]))
+        else:
+            tokens.append((tok.type, tok.string))
+    return tokenize.untokenize(tokens).strip()
+
+
+def date_field(days, field):
+    """Field (see DATE_FIELDS) of dates stored in days since 1970-01-01"""
+    d = np.asarray(days).astype("datetime64[D]")
+    years = d.astype("datetime64[Y]")
+    if field == "year":
+        return years.astype(np.int64) + 1970
+    if field == "month":
+        return (d.astype("datetime64[M]") - years).astype(np.int64) + 1
+    if field == "day":
+        return (d - d.astype("datetime64[M]")).astype(np.int64) + 1
+    if field == "dayofyear":
+        return (d - years).astype(np.int64) + 1
+    if field == "dayofweek":
+        # 1970-01-01 is a thursday, monday is 0
+        return (np.asarray(days).astype(np.int64) + 3) % 7
+    raise NotImplementedError(f"date field {field}")
+
+
+class QueryIndex:
+    """Evaluation of pandas-like query conditions on the columns of the
+    index, compiled to numpy masks
+
+    The condition is parsed with ast, every comparison between a column and
+    constants is answered with a sorted order of the column (built once, at
+    the first use of the column): a range predicate is a slice of the order
+    and an equality on a category or a date field (massif, acquisition,
+    month...) is the posting list of the value. Conditions outside this
+    grammar raise NotImplementedError.
+
+    Parameters
+    ----------
+    n : int
+        number of samples
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.columns = {}
+        self.orders = {}
+
+    @classmethod
+    def from_info(cls, names, columns, topography=None, physics=None):
+        """Index of the columns of load_info_index
+
+        Parameters
+        ----------
+        names : list
+            names of the metadata, topography and physics columns
+        columns : list
+            metadata columns (kind, values, vocabulary)
+        topography, physics : np.array, optional
+            (n, 3) arrays, by default None (not indexed)
+        """
+        index = cls(len(columns[0][1]))
+        names = list(names)
+        for kind, values, vocab in columns:
+            index.add_column(names.pop(0), kind, values, vocab)
+        for extra in [topography, physics]:
+            if extra is None:
+                continue
+            for j in range(extra.shape[1]):
+                index.add_column(names.pop(0), "number", extra[:, j])
+        return index
+
+    def add_column(self, name, kind, values, vocabulary=None):
+        """Add a column: "date" (days since 1970-01-01), "category" (codes of
+        the vocabulary) or "number" """
+        self.columns[name] = (kind, values, vocabulary)
+
+    def sorted_column(self, key):
+        """Order and sorted values (NaN last) of a column or of a field of a
+        date column, in the dtype of a float column, in float64 otherwise
+
+        Parameters
+        ----------
+        key : tuple
+            (name of the column, field or None)
+        """
+        if key not in self.orders:
+            name, field = key
+            values = np.asarray(self.columns[name][1])
+            if field is not None:
+                values = date_field(values, field)
+            order = np.argsort(values, kind="stable")
+            values = values[order]
+            if not np.issubdtype(values.dtype, np.floating):
+                values = values.astype(np.float64)
+            self.orders[key] = order, values
+        return self.orders[key]
+
+    def mask(self, condition):
+        """Boolean mask of the samples matching a pandas query condition"""
+        tree = ast.parse(normalise_condition(condition), mode="eval")
+        return self._eval(tree.body)
+
+    def select(self, condition):
+        """Positions of the samples matching a pandas query condition"""
+        return np.flatnonzero(self.mask(condition))
+
+    def _eval(self, node):
+        if isinstance(node, ast.BoolOp):
+            masks = [self._eval(v) for v in node.values]
+            if isinstance(node.op, ast.And):
+                return reduce(np.logical_and, masks)
+            return reduce(np.logical_or, masks)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return ~self._eval(node.operand)
+        if isinstance(node, ast.Compare):
+            operands = [node.left] + node.comparators
+            masks = [
+                self._compare(operands[i], op, operands[i + 1])
+                for i, op in enumerate(node.ops)
+            ]
+            return reduce(np.logical_and, masks)
+        raise NotImplementedError(ast.dump(node))
+
+    def _column(self, node):
+        if isinstance(node, ast.Name) and node.id in self.columns:
+            return node.id, None
+        if (
+            isinstance(node, ast.Attribute)
+            and node.attr in DATE_FIELDS
+            and isinstance(node.value, ast.Attribute)
+            and node.value.attr == "dt"
+            and isinstance(node.value.value, ast.Name)
+            and self.columns.get(node.value.value.id, ("",))[0] == "date"
+        ):
+            return node.value.value.id, node.attr
+        return None
+
+    def _compare(self, left, op, right):
+        op = COMPARISONS.get(type(op))
+        key = self._column(left)
+        if key is None:
+            key, op, right = self._column(right), FLIPPED.get(op), left
+        if key is None or op is None:
+            raise NotImplementedError("comparison between a column and constants")
+        value = ast.literal_eval(right)
+        if isinstance(value, (list, tuple, set)):
+            if op not in ["==", "!=", "in", "not in"]:
+                raise NotImplementedError(f"{op} with a list")
+            mask = np.zeros(self.n, dtype=bool)
+            for v in value:
+                # pandas answers the lists with isin, in float64
+                mask |= self._predicate(key, "==", v, exact=True)
+            return ~mask if op in ["!=", "not in"] else mask
+        if op in ["in", "not in"]:
+            raise NotImplementedError(f"{op} with a scalar")
+        if op == "!=":
+            return ~self._predicate(key, "==", value)
+        return self._predicate(key, op, value)
+
+    def _predicate(self, key, op, value, exact=False):
+        name, field = key
+        kind, _, vocab = self.columns[name]
+        if field is not None:
+            kind = "number"
+        if kind == "category":
+            if not isinstance(value, str) or op != "==":
+                raise NotImplementedError(f"{name} {op} {value!r}")
+            if value not in list(vocab):
+                return np.zeros(self.n, dtype=bool)
+            value = list(vocab).index(value)
+        elif kind == "date":
+            if not isinstance(value, str):
+                raise NotImplementedError(f"{name} {op} {value!r}")
+            value = pd.Timestamp(value).value / NS_PER_DAY
+        elif isinstance(value, (bool, str)) or not isinstance(value, (int, float)):
+            raise NotImplementedError(f"{name} {op} {value!r}")
+        order, values = self.sorted_column(key)
+        # compare as numpy (and pandas query) does: the literal is rounded to
+        # the dtype of the column (float32 for topography and physics), unless
+        # exact, where a literal the dtype cannot hold matches nothing
+        rounded = values.dtype.type(value)
+        if exact and rounded != value:
+            return np.zeros(self.n, dtype=bool)
+        value = rounded
+        # the NaN are sorted last and never match a comparison
+        n_valid = np.searchsorted(values, np.nan, "left")
+        if op == "==":
+            rows = order[
+                np.searchsorted(values, value, "left") : np.searchsorted(
+                    values, value, "right"
+                )
+            ]
+        elif op == "<":
+            rows = order[: np.searchsorted(values, value, "left")]
+        elif op == "<=":
+            rows = order[: np.searchsorted(values, value, "right")]
+        elif op == ">":
+            rows = order[np.searchsorted(values, value, "right") : n_valid]
+        else:
+            rows = order[np.searchsorted(values, value, "left") : n_valid]
+        mask = np.zeros(self.n, dtype=bool)
+        mask[rows] = True
+        return mask
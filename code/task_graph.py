@@ -0,0 +1,103 @@
+from joblib.externals.loky import get_reusable_executor
+from multiprocessing import get_context
+from queue import Empty
+from os import cpu_count
+import traceback
+import time
+
+
+def resolve_workers(workers, budget):
+    """Number of workers of a joblib-like value (-1 for all) within a budget"""
+    if workers is None or workers < 0:
+        return budget
+    return max(min(workers, budget), 1)
+
+
+def run_stage(queue, name, function, workers, results):
+    """Body of the process of a task: call the function and send back its
+    result (or the traceback of its error)
+
+    joblib keeps one pool of workers per process, the task being alone in
+    its process, its pool is sized to the workers granted to the task. The
+    pool is shut down at the end so that the process can exit.
+    """
+    try:
+        message = (name, "done", function(workers, results))
+    except Exception:
+        message = (name, "error", traceback.format_exc())
+    get_reusable_executor().shutdown(wait=True)
+    queue.put(message)
+
+
+def run_task_graph(tasks, workers=-1, poll=1.0):
+    """Run a graph of tasks, each in its own process: a task starts as soon
+    as its dependencies are done and the worker budget is shared between
+    the tasks running at the same time
+
+    Parameters
+    ----------
+    tasks : dict
+        name -> (dependencies, workers, function), the function (picklable,
+        defined at the top level of a module) is called with the number of
+        workers granted and the results of the tasks already done
+    workers : int, optional
+        global worker budget, by default -1 (all the cores)
+    poll : float, optional
+        period (seconds) of the check of the processes, by default 1.0
+
+    Returns
+    -------
+    dict
+        name -> result of the task
+    """
+    budget = resolve_workers(workers, cpu_count())
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    results, running, granted = {}, {}, {}
+    try:
+        while len(results) < len(tasks):
+            ready = [
+                name
+                for name, (deps, _, _) in tasks.items()
+                if name not in results
+                and name not in running
+                and all(d in results for d in deps)
+            ]
+            for k, name in enumerate(ready):
+                free = budget - sum(granted.values())
+                share = max(free // (len(ready) - k), 1)
+                granted[name] = resolve_workers(tasks[name][1], share)
+                print(f"start {name} with {granted[name]} workers")
+                running[name] = ctx.Process(
+                    target=run_stage,
+                    args=(queue, name, tasks[name][2], granted[name], dict(results)),
+                )
+                running[name].start()
+            if len(running) == 0:
+                raise ValueError("unknown dependency or cycle in the task graph")
+            try:
+                name, status, value = queue.get(timeout=poll)
+            except Empty:
+                dead = [n for n, p in running.items() if p.exitcode not in [None, 0]]
+                if dead:
+                    raise RuntimeError(f"task {dead[0]} died without result")
+                continue
+            running.pop(name).join()
+            del granted[name]
+            if status == "error":
+                raise RuntimeError(f"task {name} failed\n{value}")
+            results[name] = value
+    finally:
+        for p in running.values():
+            p.terminate()
+            p.join()
+    return results
+
+
+def timed_stage(name, function, kwargs, workers, results):
+    """Task calling function(workers=..., **kwargs) and printing its
+    duration (use functools.partial to bind name, function and kwargs)"""
+    t = time.time()
+    out = function(**dict(kwargs, workers=workers))
+    print(f"{name} done in {time.time() - t} seconds")
+    return out
@@ -0,0 +1,4 @@
+import sys
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "code"))
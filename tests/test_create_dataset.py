@@ -0,0 +1,254 @@
+import glob
+from os import makedirs, remove, utime
+from os.path import join, basename, exists, getsize
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+pytest.importorskip("tqdm")
+pytest.importorskip("matplotlib")
+
+import P2_create_dataset as P2
+from bench_h5_layout import synthetic_dataset
+from dataset_load import save_h5_II, load_h5_II, merge_h5_II
+from manifest import Manifest, params_hash
+
+
+def cache_key(name):
+    return params_hash(name)[:16]
+
+
+def entry_size(cache_dir, name, key):
+    return sum(getsize(p) for p in P2.patch_cache_files(cache_dir, name, key))
+
+
+def assert_same_h5(a, b):
+    Xa, ya = load_h5_II(a)
+    Xb, yb = load_h5_II(b)
+    assert np.array_equal(Xa, Xb)
+    for f in ["metadata", "topography", "physics"]:
+        assert np.array_equal(ya[f], yb[f])
+
+
+def test_patch_cache_round_trip(tmp_path):
+    cache_dir = str(tmp_path)
+    X, y = synthetic_dataset(6, seed=0)
+    P2.save_patch_cache(cache_dir, "ARAVIS_20200801", cache_key("a"), X, y)
+    X_c, y_c = P2.load_patch_cache(cache_dir, "ARAVIS_20200801", cache_key("a"))
+    assert np.array_equal(X_c, X)
+    for f in P2.PATCH_CACHE_FIELDS:
+        assert np.array_equal(y_c[f], y[f])
+    assert P2.load_patch_cache(cache_dir, "ARAVIS_20200801", cache_key("b")) is None
+    # a new key of the image replaces the old entry
+    P2.save_patch_cache(cache_dir, "ARAVIS_20200801", cache_key("b"), X[:2], y)
+    assert len(glob.glob(join(cache_dir, "*.npy"))) == 4
+    assert P2.load_patch_cache(cache_dir, "ARAVIS_20200801", cache_key("a")) is None
+    # an image without patch
+    P2.save_patch_cache(
+        cache_dir, "BAUGES_20200801", cache_key("a"), np.array([]), np.array([])
+    )
+    X_c, y_c = P2.load_patch_cache(cache_dir, "BAUGES_20200801", cache_key("a"))
+    assert len(X_c) == 0 and len(y_c) == 0
+    # an incomplete entry is a miss
+    remove(P2.patch_cache_files(cache_dir, "ARAVIS_20200801", cache_key("b"))[-1])
+    assert P2.load_patch_cache(cache_dir, "ARAVIS_20200801", cache_key("b")) is None
+    assert not glob.glob(join(cache_dir, "*.tmp"))
+
+
+def test_patch_cache_evicts_the_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path)
+    names = ["ARAVIS_20200801", "BAUGES_20200801", "VERCORS_20200801"]
+    for k, name in enumerate(names):
+        X, y = synthetic_dataset(4, seed=k)
+        P2.save_patch_cache(cache_dir, name, cache_key(name), X, y)
+        path = P2.patch_cache_files(cache_dir, name, cache_key(name))[0]
+        utime(path, (1000 * (k + 1), 1000 * (k + 1)))
+    sizes = {n: entry_size(cache_dir, n, cache_key(n)) for n in names}
+    assert P2.evict_patch_cache(cache_dir, sum(sizes.values())) == sum(sizes.values())
+    # the oldest entry becomes the most recently used
+    assert P2.load_patch_cache(cache_dir, names[0], cache_key(names[0])) is not None
+    total = P2.evict_patch_cache(cache_dir, sizes[names[0]] + sizes[names[2]])
+    assert total == sizes[names[0]] + sizes[names[2]]
+    assert P2.load_patch_cache(cache_dir, names[1], cache_key(names[1])) is None
+    assert not glob.glob(join(cache_dir, names[1] + "*"))
+    assert P2.evict_patch_cache(cache_dir, sizes[names[0]]) == sizes[names[0]]
+    assert P2.load_patch_cache(cache_dir, names[0], cache_key(names[0])) is not None
+    assert P2.evict_patch_cache(cache_dir, 0) == 0
+    assert not glob.glob(join(cache_dir, "*"))
+
+
+def test_manifest_follows_the_content_of_the_inputs(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("a")
+    output = tmp_path / "output.txt"
+    output.write_text("out")
+    path = str(tmp_path / "manifest.json")
+    manifest = Manifest(path)
+    key = manifest.key([str(source)], {"step": 15})
+    assert not manifest.is_current("source", key)
+    manifest.record("source", key, [str(output)], n=3)
+    manifest.save()
+    manifest = Manifest(path)
+    assert manifest.is_current("source", manifest.key([str(source)], {"step": 15}))
+    assert manifest.entries["source"]["n"] == 3
+    assert manifest.key([str(source)], {"step": 10}) != key
+    # a new mtime without a new content keeps the key
+    utime(source, (1000, 1000))
+    assert manifest.key([str(source)], {"step": 15}) == key
+    source.write_text("b")
+    assert manifest.key([str(source)], {"step": 15}) != key
+    remove(output)
+    assert not manifest.is_current("source", key)
+    # an unreadable manifest is an empty one
+    with open(path, "w") as f:
+        f.write("{")
+    assert Manifest(path).entries == {}
+
+
+def test_merge_dataset_appends_then_rebuilds(tmp_path, capsys):
+    shards = []
+    for k in range(3):
+        X, y = synthetic_dataset(5 + k, seed=k)
+        shards.append(str(tmp_path / f"shard_{k}.h5"))
+        save_h5_II(X, y, shards[-1])
+    acquisitions = ["ASC", "DSC", "DSC"]
+    filename = str(tmp_path / "merged.h5")
+    reference = str(tmp_path / "reference.h5")
+
+    assert P2.merge_dataset(shards[:2], acquisitions[:2], filename) == 11
+    assert "merge 2 shard(s)" in capsys.readouterr().out
+    assert P2.merge_dataset(shards[:2], acquisitions[:2], filename) == 11
+    assert "merge 0 shard(s)" in capsys.readouterr().out
+    # a new shard is appended
+    assert P2.merge_dataset(shards, acquisitions, filename) == 18
+    out = capsys.readouterr().out
+    assert "merge 1 shard(s)" in out and "rebuild" not in out
+    merge_h5_II(shards, reference, acquisitions=acquisitions)
+    assert_same_h5(filename, reference)
+    # a modified shard rebuilds the file
+    X, y = synthetic_dataset(4, seed=10)
+    save_h5_II(X, y, shards[1])
+    assert P2.merge_dataset(shards, acquisitions, filename) == 16
+    assert "merge 3 shard(s) in %s (rebuild)" % filename in capsys.readouterr().out
+    merge_h5_II(shards, reference, acquisitions=acquisitions)
+    assert_same_h5(filename, reference)
+    # so does a removed one
+    assert P2.merge_dataset(shards[1:], acquisitions[1:], filename) == 11
+    assert "(rebuild)" in capsys.readouterr().out
+    merge_h5_II(shards[1:], reference, acquisitions=acquisitions[1:])
+    assert_same_h5(filename, reference)
+
+
+@pytest.fixture
+def extraction(tmp_path, monkeypatch):
+    """Scenes stored as .npy in .tif files, labelled without Crocus table
+
+    Returns the list of the scenes read by load_data, the scenes listed in
+    fail raise an error as an interrupted run.
+    """
+    read, fail = [], set()
+
+    def load_data(i):
+        if basename(i) in fail:
+            raise RuntimeError("interrupted")
+        read.append(basename(i))
+        return np.load(i), None
+
+    def add_labels_II(data, name_file, table, type_d):
+        massif, date = basename(name_file)[:-4].split("_")[:2]
+        y = {
+            "metadata": np.array([[date, massif, type_d]] * len(data), np.string_),
+            "topography": data[:, 0, 0, 3:6].copy(),
+            "physics": data[:, 0, 0, 6:9].copy(),
+        }
+        return data, y
+
+    monkeypatch.setattr(P2, "load_data", load_data)
+    monkeypatch.setattr(P2, "add_labels_II", add_labels_II)
+    monkeypatch.setattr(P2, "prepare_crocus_table", lambda csv_GT, path: path)
+    monkeypatch.setattr(P2, "load_crocus_table", lambda path: {"key": "v1"})
+    return read, fail
+
+
+def write_scene(path, seed):
+    x = np.random.default_rng(seed).uniform(0.1, 1, (30, 45, 9)).astype(np.float32)
+    with open(path, "wb") as f:
+        np.save(f, x)
+
+
+def test_create_dataset_restarts_and_adds_a_new_scene(
+    tmp_path, extraction, monkeypatch
+):
+    read, fail = extraction
+    makedirs(tmp_path / "E0" / "DSC")
+    scenes = [f"M{k}_202008{k + 1:02d}.tif" for k in range(7)]
+    for k, s in enumerate(scenes[:6]):
+        write_scene(tmp_path / "E0" / "DSC" / s, k)
+    csv_GT = [str(tmp_path / "tel.pkl")]
+    (tmp_path / "tel.pkl").write_bytes(b"crocus")
+    out = tmp_path / "out"
+    cache_dir = str(out / "temp" / "patches")
+    manifest_path = str(out / "temp" / "manifest_step2.json")
+    evictions = []
+    evict = P2.evict_patch_cache
+    monkeypatch.setattr(
+        P2, "evict_patch_cache", lambda d, m: evictions.append(evict(d, m))
+    )
+
+    def run(cache_size=2**30, incremental=True):
+        return P2.create_dataset(
+            str(tmp_path / "E0"),
+            str(out),
+            ["DSC"],
+            csv_GT,
+            15,
+            (0, 15),
+            "DSC",
+            1,
+            True,
+            incremental,
+            cache_size,
+        )
+
+    # interrupted on the fifth scene, after a first batch of 4 scenes
+    fail.add(scenes[4])
+    with pytest.raises(RuntimeError):
+        run()
+    assert read == scenes[:4]
+    assert len(Manifest(manifest_path).entries) == 4
+    assert len(glob.glob(join(cache_dir, "*_????????????????.npy"))) == 4
+    # the restart only extracts the scenes of the interrupted batch
+    fail.clear()
+    read.clear()
+    shards = run()
+    assert read == scenes[4:6]
+    assert [basename(s) for s in shards] == [s[:-4] + ".h5" for s in scenes[:6]]
+    for k, s in enumerate(shards):
+        X, y = load_h5_II(s)
+        assert X.shape == (6, 15, 15, 9)
+        assert (y["metadata"][:, 1] == f"M{k}").all()
+    virtual = str(out / "final_E4" / "data_DSC_VX.h5")
+    assert len(load_h5_II(virtual)[0]) == 36
+    # a new scene
+    write_scene(tmp_path / "E0" / "DSC" / scenes[6], 6)
+    read.clear()
+    shards = run()
+    assert read == scenes[6:]
+    assert len(shards) == 7 and len(load_h5_II(virtual)[0]) == 42
+    # without the manifest, every scene comes from the patch cache
+    before = [load_h5_II(s) for s in shards]
+    remove(manifest_path)
+    read.clear()
+    assert run() == shards
+    assert read == []
+    for (X, y), s in zip(before, shards):
+        X_s, y_s = load_h5_II(s)
+        assert np.array_equal(X, X_s)
+        assert np.array_equal(y["metadata"], y_s["metadata"])
+    # the cap holds after each batch of the extraction
+    evictions.clear()
+    cap = sum(getsize(p) for p in glob.glob(join(cache_dir, "M0_*.npy")))
+    run(cache_size=cap, incremental=False)
+    assert len(evictions) == 2
+    assert all(total <= cap for total in evictions)
+    assert exists(manifest_path)
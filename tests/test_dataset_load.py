@@ -0,0 +1,166 @@
+from os.path import exists
+from os import listdir
+import numpy as np
+import pytest
+
+import dataset_load
+from bench_h5_layout import synthetic_dataset
+from dataset_load import (
+    save_h5_II,
+    build_info_index,
+    index_is_valid,
+    index_path,
+    load_info_index,
+    shuffle_data,
+    Dataset_loader,
+)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    X, y = synthetic_dataset(500, seed=0)
+    path = str(tmp_path / "data.h5")
+    save_h5_II(X, y, path, chunks=16)
+    return path, X, y
+
+
+def test_index_build_leaves_no_temporary(dataset, tmp_path):
+    path, X, y = dataset
+    build_info_index(path)
+    assert index_is_valid(path)
+    assert sorted(listdir(tmp_path)) == ["data.h5", "data.h5.index"]
+    # rebuilding over an existing index replaces it
+    columns, topography, physics = load_info_index(path, rebuild=True)
+    assert np.allclose(topography, y["topography"])
+    assert sorted(listdir(tmp_path)) == ["data.h5", "data.h5.index"]
+
+
+def test_interrupted_index_build_is_not_valid(dataset, tmp_path, monkeypatch):
+    path, _, _ = dataset
+
+    def broken_save(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(dataset_load.np, "save", broken_save)
+    with pytest.raises(KeyboardInterrupt):
+        build_info_index(path)
+    monkeypatch.undo()
+    assert not exists(index_path(path))
+    assert not index_is_valid(path)
+    assert listdir(tmp_path) == ["data.h5"]
+
+
+def test_cached_request_cannot_be_corrupted(dataset):
+    path, _, _ = dataset
+    condition = "massif == 'ARAVIS' and elevation > 1000"
+    for cache_size in [2**30, 0]:
+        loader = Dataset_loader(
+            path, shuffle=True, print_info=False, cache_size=cache_size
+        )
+        X, y = loader.request_data(condition)
+        X_ref, metadata_ref = X.copy(), y["metadata"].copy()
+        # the results are writable, cached or not
+        X[0] = 0
+        shuffle_data(X, y, seed=1)
+        for _ in range(2):
+            X2, y2 = loader.request_data(condition)
+            assert np.array_equal(X2, X_ref)
+            assert np.array_equal(y2["metadata"], metadata_ref)
+            X2[:] = -1
+            y2["metadata"][:] = ""
+        assert loader.cache_info()["hits"] == (2 if cache_size else 0)
+
+
+def test_sample_without_candidates_is_empty(dataset):
+    path, X, _ = dataset
+    loader = Dataset_loader(path, print_info=False)
+    Xs, ys = loader.sample(10, stratify_on="massif", condition="elevation > 1e6")
+    assert len(loader.idx_sample) == 0
+    assert Xs.shape == (0,) + X.shape[1:]
+    assert all(len(v) == 0 for v in ys.values())
+
+
+def test_sample_rejects_invalid_weights(dataset):
+    path, _, _ = dataset
+    loader = Dataset_loader(path, print_info=False)
+    loader.select("elevation > 0")
+    _, labels = loader.strata(np.asarray(loader.idx_request), "massif")
+    with pytest.raises(ValueError):
+        loader.sample(10, stratify_on="massif", weights=[1] * (len(labels) + 1))
+    with pytest.raises(ValueError):
+        loader.sample(10, stratify_on="massif", weights=[0] * len(labels))
+    with pytest.raises(ValueError):
+        loader.sample(10, stratify_on="massif", weights={"not a massif": 1})
+    Xs, _ = loader.sample(10, stratify_on="massif", weights={labels[0]: 1})
+    assert len(Xs) == 10
+
+
+def test_group_kfold_too_few_groups_is_silent(dataset, capsys):
+    path, _, _ = dataset
+    loader = Dataset_loader(path, print_info=False)
+    folds = list(loader.group_kfold(k=1000, condition="elevation > 0"))
+    assert folds == []
+    assert capsys.readouterr().out == ""
+
+
+@pytest.mark.parametrize("layout", [1, 2])
+def test_request_reads_only_the_requested_labels(tmp_path, monkeypatch, layout):
+    X, y = synthetic_dataset(300, seed=2)
+    path = str(tmp_path / "data.h5")
+    save_h5_II(X, y, path, chunks=16, layout=layout)
+
+    def full_decode(*args, **kwargs):
+        raise AssertionError("the whole metadata is decoded")
+
+    monkeypatch.setattr(dataset_load, "load_info_h5", full_decode)
+    loader = Dataset_loader(path, shuffle=True, print_info=False)
+    Xr, yr = loader.request_data("massif == 'BAUGES' and elevation < 1500")
+    idx = loader.idx_request
+    order = np.random.default_rng(loader.seed).permutation(idx)
+    assert np.array_equal(Xr, X[order])
+    assert np.array_equal(yr["metadata"], y["metadata"][order].astype(str))
+    assert np.array_equal(yr["physics"], y["physics"][order])
+    Xe, ye = loader.request_data("elevation > 1e6")
+    assert len(Xe) == 0 and all(len(v) == 0 for v in ye.values())
+
+
+@pytest.mark.parametrize("layout", [1, 2])
+def test_batch_labels_come_from_the_index(tmp_path, monkeypatch, layout):
+    X, y = synthetic_dataset(300, seed=4)
+    y["physics"][::7, 0] = np.nan
+    path = str(tmp_path / "data.h5")
+    save_h5_II(X, y, path, chunks=16, layout=layout)
+    loader = Dataset_loader(path, shuffle=True, print_info=False)
+    loader.select("elevation > 500")
+    views = next(loader.group_kfold(k=2))
+
+    def file_labels(*args, **kwargs):
+        raise AssertionError("the labels are read from the hdf5 file")
+
+    monkeypatch.setattr(dataset_load, "read_info_rows_h5", file_labels)
+    batches = list(loader.iter_batches(batch_size=32))
+    batches += list(views[1].iter_batches(batch_size=32))
+    for Xb, yb in batches:
+        rows = [np.flatnonzero((X == x).all(axis=(1, 2, 3)))[0] for x in Xb]
+        assert np.array_equal(yb["metadata"], y["metadata"][rows].astype(str))
+        assert np.array_equal(yb["topography"], y["topography"][rows])
+        assert np.array_equal(yb["physics"], y["physics"][rows], equal_nan=True)
+    n_request = len(loader.idx_request)
+    assert sum(len(Xb) for Xb, _ in batches) == n_request + len(views[1])
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 7, 300])
+@pytest.mark.parametrize("block_bytes", [1, 40, 200, 2**30])
+def test_permute_inplace_matches_fancy_indexing(n, block_bytes):
+    rng = np.random.default_rng(n)
+    swaps = np.arange(n)
+    q = rng.permutation(n)[: n // 2 * 2].reshape(-1, 2)
+    swaps[q[:, 0]], swaps[q[:, 1]] = q[:, 1], q[:, 0]
+    for perm in [rng.permutation(n), swaps, np.arange(n)]:
+        for array in [
+            rng.random((n, 2, 3)).astype(np.float32),
+            np.array([str(v) for v in range(n)]),
+        ]:
+            expected = array[perm]
+            dataset_load.permute_inplace(array, perm, block_bytes=block_bytes)
+            assert np.array_equal(array, expected)
@@ -0,0 +1,226 @@
+import glob
+from os import makedirs
+from os.path import join, exists
+import numpy as np
+import pytest
+
+pytest.importorskip("osgeo")
+pytest.importorskip("tqdm")
+from osgeo import gdal, ogr, osr
+
+from geo_tools import (
+    load_data,
+    raster_grid,
+    massif_windows,
+    cached_massif_windows,
+    clip_raster_massifs,
+    mask_layover,
+    build_stack_vrt,
+    stack_rasters,
+    apply_function,
+    fused_scene_pass,
+    scan_headers,
+    incompatible_headers,
+    check_data,
+)
+
+GT = (1000.0, 10.0, 0.0, 2000.0, 0.0, -10.0)
+MASSIFS = {
+    # inside the grid, the mask is a triangle
+    "A": "POLYGON ((1050 1950, 1250 1950, 1050 1750, 1050 1950))",
+    # across the right edge of the grid
+    "B": "POLYGON ((1300 1900, 1500 1900, 1500 1800, 1300 1800, 1300 1900))",
+}
+
+
+def wkt(epsg):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return srs.ExportToWkt()
+
+
+def write_raster(path, array, gt=GT, epsg=32631, nodata=None):
+    rows, cols, bands = array.shape
+    ds = gdal.GetDriverByName("GTiff").Create(
+        str(path), cols, rows, bands, gdal.GDT_Float32
+    )
+    ds.SetGeoTransform(gt)
+    ds.SetProjection(wkt(epsg))
+    for i in range(bands):
+        band = ds.GetRasterBand(i + 1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(array[:, :, i])
+    ds = None
+    return str(path)
+
+
+def write_shapefile(path, polygons, epsg=32631):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(str(path))
+    lyr = ds.CreateLayer("massifs", srs=srs, geom_type=ogr.wkbPolygon)
+    lyr.CreateField(ogr.FieldDefn("id", ogr.OFTString))
+    for name, polygon in polygons.items():
+        ft = ogr.Feature(lyr.GetLayerDefn())
+        ft.SetField("id", name)
+        ft.SetGeometry(ogr.CreateGeometryFromWkt(polygon))
+        lyr.CreateFeature(ft)
+        ft = None
+    ds = None
+    return str(path)
+
+
+def nodata_values(path):
+    ds = gdal.Open(path)
+    values = [ds.GetRasterBand(i + 1).GetNoDataValue() for i in range(ds.RasterCount)]
+    ds = None
+    return values
+
+
+@pytest.fixture
+def scene(tmp_path):
+    """Scene (2 bands), layover mask, auxiliary raster and massifs"""
+    rng = np.random.default_rng(0)
+    data = rng.uniform(0.01, 1, (30, 40, 2)).astype(np.float32)
+    data[rng.random((30, 40)) < 0.05, 0] = 0
+    layover = np.zeros((30, 40, 1), dtype=np.float32)
+    layover[::4, ::3] = 1
+    aux = rng.uniform(100, 3000, (30, 40, 1)).astype(np.float32)
+    aux[:3] = 0
+    makedirs(tmp_path / "scene")
+    return {
+        "scene": write_raster(tmp_path / "scene" / "s1.tif", data),
+        "mask": write_raster(tmp_path / "mask.tif", layover),
+        "aux": write_raster(tmp_path / "aux.tif", aux),
+        "shp": write_shapefile(tmp_path / "massifs.shp", MASSIFS),
+    }
+
+
+def test_clip_raster_massifs_matches_a_cutline(scene, tmp_path):
+    rng = np.random.default_rng(2)
+    data = rng.uniform(1, 2, (30, 40, 2)).astype(np.float32)
+    data[5:8, 5:9, 1] = -1
+    source = write_raster(tmp_path / "nodata.tif", data, nodata=-1)
+    gt, projection, size = raster_grid(source)
+    windows = massif_windows(scene["shp"], gt, projection, size)
+    outputs = {name: str(tmp_path / f"{name}.tif") for name in windows}
+    clip_raster_massifs(source, windows, outputs)
+    for name, (window, inside) in windows.items():
+        xoff, yoff, xsize, ysize = window
+        expected = data[yoff : yoff + ysize, xoff : xoff + xsize].copy()
+        expected[expected == -1] = -999
+        expected[~inside] = -999
+        array, (gt_out, _) = load_data(outputs[name])
+        assert np.array_equal(array, expected)
+        assert np.allclose(
+            gt_out, (GT[0] + 10 * xoff, 10, 0, GT[3] - 10 * yoff, 0, -10)
+        )
+        assert nodata_values(outputs[name]) == [-999] * 2
+
+
+def test_massif_windows_round_trip_through_the_cache(scene, tmp_path):
+    gt, projection, size = raster_grid(scene["scene"])
+    windows = massif_windows(scene["shp"], gt, projection, size)
+    assert windows["A"][0] == (5, 5, 20, 20)
+    assert windows["B"][0] == (30, 10, 10, 10)
+    assert 0 < windows["A"][1].sum() < windows["A"][1].size
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(2):
+        # computed and stored, then read back from the packed masks
+        cached = cached_massif_windows(scene["shp"], gt, projection, size, cache_dir)
+        assert len(glob.glob(join(cache_dir, "windows_*.npz"))) == 1
+        assert cached.keys() == windows.keys()
+        for name, (window, mask) in windows.items():
+            assert cached[name][0] == window
+            assert cached[name][1].dtype == bool
+            assert np.array_equal(cached[name][1], mask)
+
+
+def test_stack_rasters_union_extent_and_zeros(tmp_path):
+    rng = np.random.default_rng(1)
+    r1 = rng.uniform(1, 2, (10, 20, 2)).astype(np.float32)
+    r1[0, :5, 0] = 0
+    r2 = rng.uniform(1, 2, (12, 15, 1)).astype(np.float32)
+    r2[-1, -1, 0] = 0
+    # r2 starts 10 pixels to the east and 5 pixels to the south of r1
+    gt2 = (GT[0] + 100, GT[1], 0.0, GT[3] - 50, 0.0, GT[5])
+    sources = [
+        write_raster(tmp_path / "r1.tif", r1),
+        write_raster(tmp_path / "r2.tif", r2, gt=gt2),
+    ]
+    expected = np.full((17, 25, 3), -999, dtype=np.float32)
+    expected[:10, :20, :2] = r1
+    expected[5:, 10:, 2:] = r2
+    expected[expected == 0] = -999
+    out = stack_rasters(sources, str(tmp_path / "stack.tif"))
+    array, (gt, _) = load_data(out)
+    assert np.array_equal(array, expected)
+    assert np.allclose(gt, GT)
+    assert nodata_values(out) == [-999] * 3
+    # same result through a virtual stack
+    vrt = build_stack_vrt(sources, str(tmp_path / "stack.vrt"))
+    out = stack_rasters([vrt], str(tmp_path / "stack_vrt.tif"))
+    assert np.array_equal(load_data(out)[0], expected)
+
+
+def test_every_incompatible_header_is_reported(tmp_path, capsys):
+    makedirs(tmp_path / "h")
+    array = np.ones((4, 4, 1), dtype=np.float32)
+    write_raster(tmp_path / "h" / "a.tif", array)
+    write_raster(
+        tmp_path / "h" / "b.tif", array, gt=(1000.0, 20.0, 0, 2000.0, 0, -20.0)
+    )
+    write_raster(tmp_path / "h" / "c.tif", array, epsg=2154)
+    write_raster(tmp_path / "h" / "d.tif", array)
+    pattern = str(tmp_path / "h" / "*.tif")
+    cache_file = str(tmp_path / "headers.json")
+    headers = scan_headers(pattern, workers=1, cache_file=cache_file)
+    assert exists(cache_file)
+    assert scan_headers(pattern, workers=1, cache_file=cache_file) == headers
+    assert incompatible_headers(headers).tolist() == [False, True, True, False]
+    capsys.readouterr()
+    assert check_data(pattern, workers=1, cache_file=cache_file) == 0
+    out = capsys.readouterr().out
+    assert "2 file(s) not compatible" in out
+    assert str(tmp_path / "h" / "b.tif") in out
+    assert str(tmp_path / "h" / "c.tif") in out
+    assert str(tmp_path / "h" / "d.tif") not in out
+    projection = raster_grid(str(tmp_path / "h" / "a.tif"))[1]
+    assert check_data(str(tmp_path / "h" / "[ad].tif"), workers=1) == (10.0, projection)
+
+
+def test_fused_pass_matches_the_chained_stages(scene, tmp_path):
+    gt, projection, size = raster_grid(scene["scene"])
+    windows = massif_windows(scene["shp"], gt, projection, size)
+    dic_bands = {"1": "linear_to_db"}
+    fused = {name: str(tmp_path / "fused" / f"{name}.tif") for name in windows}
+    makedirs(tmp_path / "fused")
+    fused_scene_pass(
+        scene["scene"], windows, fused, scene["mask"], [scene["aux"]], dic_bands
+    )
+    # mask -> clip -> stack -> apply, as preprocess(fused=False)
+    masked = glob.glob(mask_layover(scene["scene"], scene["mask"], workers=1))[0]
+    clip = tmp_path / "clip"
+    makedirs(clip)
+    clip_raster_massifs(
+        masked, windows, {n: str(clip / f"{n}_S1.tif") for n in windows}
+    )
+    clip_raster_massifs(
+        scene["aux"], windows, {n: str(clip / f"{n}_DEM.tif") for n in windows}
+    )
+    for name in windows:
+        vrt = build_stack_vrt(
+            [str(clip / f"{name}_DEM.tif")], str(clip / f"{name}.vrt")
+        )
+        chained = stack_rasters(
+            [str(clip / f"{name}_S1.tif"), vrt], str(clip / f"{name}.tif")
+        )
+        apply_function(chained, dic_bands)
+        a, (gt_a, proj_a) = load_data(chained)
+        b, (gt_b, proj_b) = load_data(fused[name])
+        assert a.shape == b.shape == windows[name][0][3:1:-1] + (3,)
+        assert np.allclose(gt_a, gt_b) and proj_a == proj_b
+        assert np.array_equal(a, b)
+        assert (b == -999).any() and (b != -999).any()
+        assert nodata_values(chained) == nodata_values(fused[name]) == [-999] * 3
@@ -0,0 +1,44 @@
+import numpy as np
+
+from img_processing_II import SAR_patch_extract
+
+
+def SAR_patch_clean(x, windows_size, step, start=0):
+    """Reference list-based extraction the vectorised one replaced"""
+    xsize, ysize, _ = x.shape
+    f = [
+        x[i : i + windows_size, j : j + windows_size, :]
+        for i in range(start, xsize, step)
+        for j in range(start, ysize, step)
+        if (
+            x[i : i + windows_size, j : j + windows_size, :].shape[:2]
+            == (windows_size, windows_size)
+        )
+        & (np.all(x[i : i + windows_size, j : j + windows_size, :] != -999))
+        & (np.all(x[i : i + windows_size, j : j + windows_size, :2] > 0))
+    ]
+    return f
+
+
+def test_patch_extract_matches_reference():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0.01, 1, (97, 83, 4)).astype(np.float32)
+    x[rng.random(x.shape[:2]) < 0.001] = -999
+    x[rng.random(x.shape[:2]) < 0.001, 1] = 0
+    for windows_size, step, start in [(15, 10, 0), (15, 7, 3), (8, 8, 1)]:
+        expected = SAR_patch_clean(x, windows_size, step, start)
+        patchs = SAR_patch_extract(x, windows_size, step, start, block=5)
+        assert len(expected) > 0
+        assert patchs.dtype == np.float32
+        assert np.array_equal(patchs, np.array(expected))
+
+
+def test_patch_extract_without_valid_patch():
+    x = np.ones((40, 40, 3), dtype=np.float32)
+    x[::10, ::10] = -999
+    patchs = SAR_patch_extract(x, 15, 10)
+    assert SAR_patch_clean(x, 15, 10) == []
+    assert patchs.shape == (0, 15, 15, 3)
+    assert patchs.dtype == np.float32
+    # smaller than a window
+    assert SAR_patch_extract(x[:10], 15, 10).shape == (0, 15, 15, 3)
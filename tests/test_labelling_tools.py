@@ -0,0 +1,119 @@
+from os.path import basename
+import numpy as np
+import pandas as pd
+
+from labelling_tools import (
+    ALTITUDE_CLASSES,
+    SLOPE_CLASSES,
+    ORIENTATION_CLASSES,
+    extract_topo_batch,
+    compile_crocus_table,
+    crocus_lookup,
+)
+
+
+# reference per-patch labelling the batched one replaced
+def mean_angle(deg):
+    deg = np.deg2rad(deg)
+    x = np.mean(np.cos(deg))
+    y = np.mean(np.sin(deg))
+    res = np.rad2deg(np.arctan2(y, x)).round(3)
+    if res < 0:
+        return max(res, 360 + res)
+    else:
+        return res
+
+
+def altitude_plage(plg):
+    h = np.arange(0, 5100, 300)
+    altitude = h[np.argmin(np.abs(h - plg))]
+    return altitude
+
+
+def theta_plage(theta):
+    t0 = np.arange(22.5, 360 + 22.5, 45)
+    t = np.arange(0, 360, 45)
+    if theta > t0[-1] or theta < t0[0]:
+        ct = t[0]
+    else:
+        ind = np.where(theta < t0)[0][0]
+        ct = t[ind]
+    return ct
+
+
+def pente_plage(p):
+    if (p < 2) & (p >= 0):
+        pente = 0
+    elif (p < 30) & (p >= 2):
+        pente = 20
+    else:
+        pente = 45
+    return pente
+
+
+def extract_topo(img):
+    altitude = img[:, :, 3].mean()
+    orientation = mean_angle(img[:, :, 4])
+    pente = img[:, :, 5].mean()
+    return altitude_plage(altitude), pente_plage(pente), theta_plage(orientation)
+
+
+def expert_label_snow(i, tel, hpo):
+    name_base = basename(i)[:-4]
+    massif = name_base.split("_")[0]
+    date_sample = name_base.split("_")[1]
+    if (hpo in list(tel[0][massif].keys())) and (hpo in list(tel[1][massif].keys())):
+        try:
+            dframe_sample = (
+                tel[0][massif][hpo].loc[date_sample],
+                tel[1][massif][hpo].loc[date_sample],
+                tel[2][massif][hpo].loc[date_sample],
+            )
+        except KeyError:
+            return -1
+    else:
+        return -1
+    if any(d.isnull().values.any() for d in dframe_sample):
+        return -1
+    return [dframe_sample[0].tmin, dframe_sample[1].hs, dframe_sample[2].tel]
+
+
+def test_extract_topo_batch_matches_reference():
+    rng = np.random.default_rng(0)
+    imgs = np.zeros((200, 6, 6, 6), dtype=np.float32)
+    imgs[..., 3] = rng.uniform(0, 4000, (200, 1, 1)) + rng.normal(0, 50, (200, 6, 6))
+    imgs[..., 4] = rng.uniform(0, 360, (200, 1, 1)) + rng.normal(0, 10, (200, 6, 6))
+    imgs[..., 4] %= 360
+    imgs[..., 5] = rng.uniform(0, 50, (200, 1, 1)) + rng.normal(0, 1, (200, 6, 6))
+    expected = np.array([extract_topo(img) for img in imgs])
+    assert np.array_equal(extract_topo_batch(imgs), expected)
+
+
+def test_crocus_lookup_matches_reference():
+    rng = np.random.default_rng(1)
+    dates = ["20200101", "20200113", "20200125"]
+    classes = [
+        (int(a), int(p), int(t))
+        for a in ALTITUDE_CLASSES[5:8]
+        for p in SLOPE_CLASSES
+        for t in ORIENTATION_CLASSES[:3]
+    ]
+    tel = [{}, {}, {}]
+    for massif in ["ARAVIS", "VERCORS"]:
+        for k, column in enumerate(["tmin", "hs", "tel"]):
+            tel[k][massif] = {}
+            for hpo in classes[: len(classes) - 2 * k]:
+                values = rng.normal(size=len(dates))
+                values[rng.random(len(dates)) < 0.2] = np.nan
+                tel[k][massif][hpo] = pd.DataFrame({column: values}, index=dates)
+    table = compile_crocus_table(tel)
+    hpo = np.array(classes + [(0, 0, 0), (1500, 45, 315)])
+    for massif in ["ARAVIS", "VERCORS"]:
+        for date in dates + ["20200102"]:
+            labels = crocus_lookup(table, massif, date, hpo)
+            for h, label in zip(hpo, labels):
+                ref = expert_label_snow(f"{massif}_{date}.tif", tel, tuple(h))
+                if ref == -1:
+                    assert np.isnan(label).all()
+                else:
+                    assert np.allclose(label, np.array(ref, dtype=np.float32))
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from bench_h5_layout import synthetic_dataset
+from dataset_load import save_h5_II, Dataset_loader
+
+
+@pytest.fixture
+def loader(tmp_path):
+    X, y = synthetic_dataset(400, seed=3)
+    # float literals that are not exact in float32, and missing values
+    y["physics"][:50, 1] = np.float32(0.1)
+    y["topography"][50:100, 0] = np.float32(1800.3)
+    y["physics"][100:110, 2] = np.nan
+    path = str(tmp_path / "data.h5")
+    save_h5_II(X, y, path)
+    return Dataset_loader(path, print_info=False)
+
+
+@pytest.mark.parametrize(
+    "condition",
+    [
+        "tel == 0.1",
+        "tel != 0.1",
+        "tel > 0.1",
+        "tel >= 0.1",
+        "tel < 0.1",
+        "tel <= 0.1",
+        "0.1 < tel <= 5",
+        "elevation == 1800.3",
+        "elevation > 1800.3 and slope < 20",
+        "hsnow > 2 or hsnow <= 1",
+        "not (hsnow > 2)",
+        "elevation in [1800.3, 0.5]",
+        "tel in [0.1, 0.5]",
+        "tel not in [0.5, 1]",
+        "massif == 'ARAVIS' and elevation >= 1000",
+        "massif in ['BAUGES', 'VERCORS'] | aquisition == 'ASC'",
+        "date > '2021-01-01' and date.dt.month == 3",
+        "date.dt.dayofweek < 2",
+    ],
+)
+def test_compiled_query_matches_pandas(loader, condition):
+    expected = loader.infos.query(condition).index.values
+    assert np.array_equal(loader.query_index.select(condition), expected)
@@ -0,0 +1,53 @@
+from joblib import Parallel, delayed
+from threading import Thread
+import pytest
+import os
+import time
+
+import task_graph
+from task_graph import run_task_graph
+
+
+def worker_pid():
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def parallel_stage(workers, results):
+    pids = Parallel(n_jobs=workers)(delayed(worker_pid)() for _ in range(8 * workers))
+    return {"workers": workers, "pids": set(pids), "pid": os.getpid()}
+
+
+def gather(workers, results):
+    return sorted(results)
+
+
+def test_concurrent_stages_get_their_own_pool(monkeypatch):
+    monkeypatch.setattr(task_graph, "cpu_count", lambda: 7)
+    tasks = {
+        "a": ([], -1, parallel_stage),
+        "b": ([], -1, parallel_stage),
+        "c": (["a", "b"], 1, gather),
+    }
+    out = {}
+    runner = Thread(target=lambda: out.update(run_task_graph(tasks, -1, poll=0.2)))
+    runner.start()
+    runner.join(timeout=180)
+    assert not runner.is_alive(), "the task graph did not progress"
+    a, b = out["a"], out["b"]
+    # uneven split of the budget: 3 + 4 workers
+    assert sorted([a["workers"], b["workers"]]) == [3, 4]
+    assert a["pid"] != b["pid"]
+    assert len(a["pids"]) <= a["workers"] and len(b["pids"]) <= b["workers"]
+    assert a["pids"].isdisjoint(b["pids"])
+    assert out["c"] == ["a", "b"]
+
+
+def failing_stage(workers, results):
+    raise ValueError("broken stage")
+
+
+def test_failing_stage_raises():
+    tasks = {"a": ([], 1, failing_stage)}
+    with pytest.raises(RuntimeError, match="broken stage"):
+        run_task_graph(tasks, 1, poll=0.2)